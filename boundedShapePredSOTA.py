@@ -7,7 +7,7 @@ import matplotlib.pyplot as plt
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.utils.data import Dataset, DataLoader, Subset
+from torch.utils.data import Dataset, DataLoader, Subset, Sampler
 import torchvision.transforms.functional as TF
 import random
 import time
@@ -50,14 +50,18 @@ def generate_deterministic_context_points(
        that many points from the interior mask pixels.
     3) Never pad with [0,0].
     """
-    pts = []
+    # Rows are written straight into a preallocated buffer; float64 keeps the
+    # per-point arithmetic identical to the old list-of-floats implementation.
+    out = np.empty((max(N_total, N_boundary, 0), 2), dtype=np.float64)
+    n = 0
 
     # --- 1) Boundary sampling ---
     if N_boundary > 0 and parent_verts_scaled is not None and len(parent_verts_scaled) >= 2:
         verts = np.asarray(parent_verts_scaled, dtype=np.float32)
         # a) original vertices
         take_verts = min(len(verts), N_boundary)
-        pts.extend(verts[:take_verts].tolist())
+        out[:take_verts] = verts[:take_verts]
+        n = take_verts
 
         # b) evenly‐spaced extras along edges
         extra = N_boundary - take_verts
@@ -69,14 +73,14 @@ def generate_deterministic_context_points(
             perim = lens.sum()
             dists = np.linspace(0, perim, extra, endpoint=False)
             cum   = np.concatenate([[0], np.cumsum(lens)])
-            for d in dists:
-                i = np.searchsorted(cum, d, side='right') - 1
-                t = (d - cum[i]) / (lens[i] + 1e-12)
-                p = verts[i] + t * vecs[i]
-                pts.append([float(p[0]), float(p[1])])
+            # one searchsorted for all distances
+            i = np.searchsorted(cum, dists, side='right') - 1
+            t = (dists - cum[i]) / (lens[i] + 1e-12)
+            out[n:n + extra] = verts[i] + t[:, None] * vecs[i]
+            n += extra
 
     # --- 2) Interior sampling if still short ---
-    needed = N_total - len(pts)
+    needed = N_total - n
     if needed > 0 and parent_bin is not None:
         ys, xs = np.where(parent_bin > 0)
         M       = xs.shape[0]
@@ -89,14 +93,13 @@ def generate_deterministic_context_points(
             sel[:,0] = (sel[:,0] / (W - 1 + 1e-9)) * sx
             sel[:,1] = (sel[:,1] / (H - 1 + 1e-9)) * sy
 
-            pts.extend(sel.tolist())
+            out[n:n + needed] = sel
         else:
             # no interior pixels: fall back to boundary verts if any
             if parent_verts_scaled is not None and len(parent_verts_scaled) > 0:
                 pool = np.asarray(parent_verts_scaled, dtype=np.float32)
                 idxs = np.arange(needed) % pool.shape[0]
-                fallback = pool[idxs]
-                pts.extend(fallback.tolist())
+                out[n:n + needed] = pool[idxs]
             else:
                 # last resort: uniform grid over entire canvas
                 side = int(np.ceil(np.sqrt(needed)))
@@ -106,15 +109,303 @@ def generate_deterministic_context_points(
                 grid   = np.stack([xx.ravel(), yy.ravel()], axis=1)[:needed]
                 grid[:,0] = (grid[:,0] / (W - 1 + 1e-9)) * sx
                 grid[:,1] = (grid[:,1] / (H - 1 + 1e-9)) * sy
-                pts.extend(grid.tolist())
+                out[n:n + needed] = grid
+        n += needed
+
+    # --- 3) Truncate if overshot ---
+    return out[:min(n, N_total)].astype(np.float32)
+
+
+def generate_deterministic_context_points_batch(
+    parent_verts_scaled: List[Optional[np.ndarray]],
+    parent_bins:         np.ndarray,
+    N_total:             int,
+    N_boundary:          int,
+    W:                   int,
+    H:                   int,
+    sx:                  float,
+    sy:                  float
+) -> np.ndarray:
+    """
+    Batched generate_deterministic_context_points for B parents sharing one
+    canvas: `parent_verts_scaled` is a list of B vertex arrays (or None) and
+    `parent_bins` a [B, H, W] mask stack. Returns [B, N_total, 2] float32.
+
+    Boundary and interior sampling run as array ops over all parents; only
+    parents without any interior pixels take the per-parent fallback.
+    """
+    B = parent_bins.shape[0]
+    out = np.zeros((B, N_total, 2), dtype=np.float32)
+    if B == 0 or N_total <= 0:
+        return out
+
+    # --- 1) Boundary sampling, vertex lists padded to the longest one ---
+    V = np.array([0 if v is None else len(v) for v in parent_verts_scaled], dtype=np.int64)
+    has_boundary = (V >= 2) & (N_boundary > 0)
+    take = np.where(has_boundary, np.minimum(V, N_boundary), 0)
+    extra = np.where(has_boundary, N_boundary - take, 0)
+    n_bound = take + extra
+    V_max = max(int(V.max()), 1)
+    verts = np.zeros((B, V_max, 2), dtype=np.float32)
+    for b, v in enumerate(parent_verts_scaled):
+        if V[b] > 0:
+            verts[b, :V[b]] = np.asarray(v, dtype=np.float32)
+    j = np.arange(V_max)[None, :]
+    real = j < V[:, None]
+    nxt = np.where(j + 1 < V[:, None], j + 1, 0)                               # closed loop
+    vecs = np.take_along_axis(verts, nxt[..., None], axis=1) - verts           # [B, V_max, 2]
+    lens = np.where(real, np.hypot(vecs[..., 0], vecs[..., 1]), 0).astype(np.float32)
+    perim = lens.sum(axis=1)
+    cum = np.concatenate([np.zeros((B, 1)), np.cumsum(lens, axis=1)], axis=1)
+    cum[:, 1:][~real] = np.inf                                                  # never selected
+
+    K = int(extra.max())
+    extras = np.zeros((B, max(K, 1), 2), dtype=np.float64)
+    if K > 0:
+        k = np.arange(K)[None, :]
+        dists = k * (perim[:, None].astype(np.float64) / np.maximum(extra, 1)[:, None])
+        edge = (cum[:, None, :] <= dists[..., None]).sum(axis=-1) - 1         # searchsorted(side='right') - 1
+        edge = np.clip(edge, 0, np.maximum(V - 1, 0)[:, None])
+        t = (dists - np.take_along_axis(cum, edge, axis=1)) / (np.take_along_axis(lens, edge, axis=1) + 1e-12)
+        extras = (np.take_along_axis(verts, edge[..., None], axis=1)
+                  + t[..., None] * np.take_along_axis(vecs, edge[..., None], axis=1))
+
+    # --- 2) Interior sampling: one nonzero() over the whole stack ---
+    needed = N_total - n_bound
+    bb, ys, xs = np.nonzero(parent_bins > 0)        # sorted by parent, then row-major like np.where
+    M = np.bincount(bb, minlength=B)
+    first = np.concatenate([[0], np.cumsum(M)[:-1]])
+    K_in = max(int(needed.max()), 1)
+    k = np.arange(K_in)[None, :]
+    # same indices as np.linspace(0, M-1, needed, dtype=int)
+    step = (M - 1) / np.maximum(needed - 1, 1)
+    idxs = np.floor(k * step[:, None]).astype(np.int64)
+    idxs = np.where((k == (needed - 1)[:, None]) & (needed > 1)[:, None], (M - 1)[:, None], idxs)
+    idxs = np.clip(idxs, 0, np.maximum(M - 1, 0)[:, None]) + first[:, None]
+    idxs = np.clip(idxs, 0, max(len(xs) - 1, 0))
+    interior = np.zeros((B, K_in, 2), dtype=np.float32)
+    if len(xs):
+        interior = np.stack([xs[idxs], ys[idxs]], axis=-1).astype(np.float32)
+        interior[..., 0] = (interior[..., 0] / (W - 1 + 1e-9)) * sx
+        interior[..., 1] = (interior[..., 1] / (H - 1 + 1e-9)) * sy
+
+    # --- 3) Assemble [vertices | edge extras | interior], truncated to N_total ---
+    pos = np.arange(N_total)[None, :]
+    vert_i = np.clip(pos, 0, V_max - 1)
+    extra_i = np.clip(pos - take[:, None], 0, extras.shape[1] - 1)
+    int_i = np.clip(pos - n_bound[:, None], 0, K_in - 1)
+    out[:] = np.where(
+        (pos < take[:, None])[..., None],
+        np.take_along_axis(verts, vert_i[..., None], axis=1),
+        np.where((pos < n_bound[:, None])[..., None],
+                 np.take_along_axis(extras, extra_i[..., None], axis=1),
+                 np.take_along_axis(interior, int_i[..., None], axis=1)))
+
+    # Parents with no interior pixels use the single-parent fallbacks
+    for b in np.flatnonzero((needed > 0) & (M == 0)):
+        out[b] = generate_deterministic_context_points(
+            parent_verts_scaled[b], parent_bins[b], N_total, N_boundary, W, H, sx, sy)
+    return out
+
+
+def _generate_deterministic_context_points_reference(
+    parent_verts_scaled: np.ndarray | None,
+    parent_bin:          np.ndarray,
+    N_total:             int,
+    N_boundary:          int,
+    W:                   int,
+    H:                   int,
+    sx:                  float,
+    sy:                  float
+) -> np.ndarray:
+    # Original per-point implementation, kept as the oracle for check_context_points
+    pts = []
+
+    # --- 1) Boundary sampling ---
+    if N_boundary > 0 and parent_verts_scaled is not None and len(parent_verts_scaled) >= 2:
+        verts = np.asarray(parent_verts_scaled, dtype=np.float32)
+        take_verts = min(len(verts), N_boundary)
+        pts.extend(verts[:take_verts].tolist())
+        extra = N_boundary - take_verts
+        if extra > 0:
+            edges = np.vstack([verts, verts[0]])
+            vecs  = edges[1:] - edges[:-1]
+            lens  = np.hypot(vecs[:,0], vecs[:,1])
+            perim = lens.sum()
+            dists = np.linspace(0, perim, extra, endpoint=False)
+            cum   = np.concatenate([[0], np.cumsum(lens)])
+            for d in dists:
+                i = np.searchsorted(cum, d, side='right') - 1
+                t = (d - cum[i]) / (lens[i] + 1e-12)
+                p = verts[i] + t * vecs[i]
+                pts.append([float(p[0]), float(p[1])])
+
+    # --- 2) Interior sampling if still short ---
+    needed = N_total - len(pts)
+    if needed > 0 and parent_bin is not None:
+        ys, xs = np.where(parent_bin > 0)
+        M       = xs.shape[0]
+        if M > 0:
+            idxs = np.linspace(0, M - 1, needed, dtype=int)
+            sel  = np.stack([xs[idxs], ys[idxs]], axis=1).astype(np.float32)
+            sel[:,0] = (sel[:,0] / (W - 1 + 1e-9)) * sx
+            sel[:,1] = (sel[:,1] / (H - 1 + 1e-9)) * sy
+            pts.extend(sel.tolist())
+        elif parent_verts_scaled is not None and len(parent_verts_scaled) > 0:
+            pool = np.asarray(parent_verts_scaled, dtype=np.float32)
+            idxs = np.arange(needed) % pool.shape[0]
+            pts.extend(pool[idxs].tolist())
+        else:
+            side = int(np.ceil(np.sqrt(needed)))
+            xs_lin = np.linspace(0, W-1, side)
+            ys_lin = np.linspace(0, H-1, side)
+            xx, yy = np.meshgrid(xs_lin, ys_lin, indexing='xy')
+            grid   = np.stack([xx.ravel(), yy.ravel()], axis=1)[:needed]
+            grid[:,0] = (grid[:,0] / (W - 1 + 1e-9)) * sx
+            grid[:,1] = (grid[:,1] / (H - 1 + 1e-9)) * sy
+            pts.extend(grid.tolist())
 
     # --- 3) Truncate if overshot ---
     if len(pts) > N_total:
         pts = pts[:N_total]
-
     return np.asarray(pts, dtype=np.float32)
 
+
+def _random_context_case(rng, H: int, W: int):
+    # Seeded parent for the context-point checks: maybe-empty disc mask, 0-11 vertices or None
+    mask = np.zeros((H, W), np.uint8)
+    if rng.integers(0, 5):
+        cv2.circle(mask, (int(rng.integers(0, W)), int(rng.integers(0, H))), int(rng.integers(1, min(H, W) // 3)), 255, -1)
+    nv = int(rng.integers(0, 12))
+    verts = None if nv == 0 and rng.random() < .5 else rng.uniform(0, 1, (nv, 2)).astype(np.float32)
+    return verts, mask
+
+
+def check_context_points(trials: int = 300, seed: int = 0) -> List[int]:
+    """
+    Compares generate_deterministic_context_points (exact) and
+    generate_deterministic_context_points_batch (allclose against a stack of
+    per-parent calls) with _generate_deterministic_context_points_reference on
+    seeded random masks and vertex sets. Returns the failing trial indices.
+    """
+    rng = np.random.default_rng(seed)
+    H = W = 64
+    failures = []
+    for trial in range(trials):
+        Nt, Nb = int(rng.integers(1, 80)), int(rng.integers(0, 40))
+        sx, sy = float(rng.uniform(.5, 2)), float(rng.uniform(.5, 2))
+        cases = [_random_context_case(rng, H, W) for _ in range(int(rng.integers(1, 6)))]
+        ref = [_generate_deterministic_context_points_reference(v, mk, Nt, Nb, W, H, sx, sy) for v, mk in cases]
+        single_ok = all(
+            np.array_equal(generate_deterministic_context_points(v, mk, Nt, Nb, W, H, sx, sy), r)
+            for (v, mk), r in zip(cases, ref))
+        got = generate_deterministic_context_points_batch(
+            [v for v, _ in cases], np.stack([mk for _, mk in cases]), Nt, Nb, W, H, sx, sy)
+        batch_ok = got.shape == (len(cases), Nt, 2) and np.allclose(got, np.stack(ref), atol=1e-5)
+        if not (single_ok and batch_ok):
+            failures.append(trial)
+    print(f"context points vs reference: {len(failures)} of {trials} trials differ")
+    return failures
+
 # --- GPU function ---
+def generate_deterministic_context_points_gpu_batch(
+    parent_verts_scaled: torch.Tensor | None,
+    vert_lengths:        torch.Tensor | None,
+    parent_bins:         torch.Tensor,
+    N_total:             int,
+    N_boundary:          int,
+    N_interior:          int
+) -> torch.Tensor:
+    """
+    Batched, device-resident context points for B parents sharing one canvas.
+
+    parent_verts_scaled: [B, V_max, 2] vertex lists padded to V_max (or None)
+    vert_lengths:        [B] number of real vertices per parent (None = all V_max are real)
+    parent_bins:         [B, H, W] parent masks
+    Returns [B, N_total, 2] on parent_bins.device.
+
+    Per parent the layout is the one of generate_deterministic_context_points_gpu:
+    all vertices, then evenly spaced edge points up to N_boundary (N_boundary
+    zeros if there are no vertices), then N_interior grid points inside the
+    mask, padded with the last point / truncated to N_total. Every step is a
+    fixed-shape gather, so there are no host round-trips or data-dependent
+    branches.
+    """
+    device = parent_bins.device
+    dtype = torch.float32
+    B, H, W = parent_bins.shape
+    pos = torch.arange(N_total, device=device).unsqueeze(0)                  # [1, N_total]
+
+    # 1) Boundary: vertices first, then `extra` points spread over the closed polygon
+    if parent_verts_scaled is not None and parent_verts_scaled.size(1) > 0 and N_boundary > 0:
+        V = parent_verts_scaled.to(device=device, dtype=dtype)                # [B, V_max, 2]
+        if V.dim() != 3 or V.size(0) != B:
+            raise ValueError(f"parent_verts_scaled must be [B={B}, V_max, 2], got {tuple(V.shape)}")
+        if vert_lengths is None:
+            n_verts = torch.full((B,), V.size(1), device=device, dtype=torch.long)
+        elif vert_lengths.shape != (B,):
+            raise ValueError(f"vert_lengths must be [B={B}], got {tuple(vert_lengths.shape)}")
+        else:
+            n_verts = vert_lengths.to(device=device, dtype=torch.long)        # [B]
+    else:
+        V = torch.zeros((B, 1, 2), device=device, dtype=dtype)
+        n_verts = torch.zeros(B, device=device, dtype=torch.long)
+    V_max = V.size(1)
+    has_verts = n_verts >= 1
+    extra = (N_boundary - n_verts).clamp(min=0)
+    n_bound = torch.where(has_verts, n_verts + extra, torch.full_like(n_verts, N_boundary))
+
+    j = torch.arange(V_max, device=device).unsqueeze(0)
+    real = j < n_verts.unsqueeze(1)
+    nxt = torch.where(j + 1 < n_verts.unsqueeze(1), j + 1, torch.zeros_like(j))
+    vecs = torch.gather(V, 1, nxt.unsqueeze(-1).expand(-1, -1, 2)) - V        # edge vectors of the closed loop
+    lens = vecs.norm(dim=2) * real
+    perim = lens.sum(dim=1, keepdim=True)
+    cum = torch.cat([torch.zeros((B, 1), device=device, dtype=dtype), lens.cumsum(dim=1)], dim=1)
+    cum[:, 1:] = cum[:, 1:].masked_fill(~real, float('inf'))                  # padding never matches
+
+    k_extra = (pos - n_verts.unsqueeze(1)).clamp(min=0)                       # [B, N_total]
+    frac = k_extra.to(dtype) / (extra.unsqueeze(1) - 1).clamp(min=1).to(dtype)  # linspace incl. endpoint
+    dists = perim * frac
+    edge = (torch.searchsorted(cum.contiguous(), dists.contiguous()) - 1)     # == bucketize(dists, cum) - 1
+    edge = torch.minimum(edge.clamp(min=0), (n_verts - 1).clamp(min=0).unsqueeze(1))
+    t = (dists - torch.gather(cum, 1, edge)) / (torch.gather(lens, 1, edge) + 1e-12)
+    edge2 = edge.unsqueeze(-1).expand(-1, -1, 2)
+    extra_pts = torch.gather(V, 1, edge2) + torch.gather(vecs, 1, edge2) * t.unsqueeze(-1)
+    vert_pts = torch.gather(V, 1, pos.clamp(max=V_max - 1).expand(B, -1).unsqueeze(-1).expand(-1, -1, 2))
+
+    # 2) Interior: first N_interior inside points of a g x g grid, padded with the last one
+    if N_interior > 0:
+        g = int(math.ceil(math.sqrt(N_interior)))
+        xs = torch.linspace(0, W-1, steps=g, device=device)
+        ys = torch.linspace(0, H-1, steps=g, device=device)
+        xx, yy = torch.meshgrid(xs, ys, indexing='xy')
+        cand = torch.stack([xx.reshape(-1), yy.reshape(-1)], dim=1)            # [G, 2]
+        inside = parent_bins[:, cand[:, 1].long(), cand[:, 0].long()] > 0     # [B, G]
+        n_inside = inside.sum(dim=1, keepdim=True)
+        rank = inside.long().cumsum(dim=1)                                     # k-th inside point sits where rank first hits k+1
+        k_int = (pos - n_bound.unsqueeze(1)).clamp(min=0)
+        k_int = torch.minimum(k_int, (n_inside - 1).clamp(min=0))
+        at = torch.searchsorted(rank, k_int + 1).clamp(max=cand.size(0) - 1)
+        int_pts = cand[at] / torch.tensor([W - 1 + 1e-9, H - 1 + 1e-9], device=device, dtype=dtype)
+        int_pts = int_pts * (n_inside > 0).unsqueeze(-1)
+    else:
+        int_pts = torch.zeros((B, N_total, 2), device=device, dtype=dtype)
+
+    # 3) Select per slot; slots past the last point repeat it
+    total = n_bound + N_interior
+    jj = torch.minimum(pos, (total - 1).clamp(min=0).unsqueeze(1))
+    is_vert = has_verts.unsqueeze(1) & (jj < n_verts.unsqueeze(1))
+    is_bound = jj < n_bound.unsqueeze(1)
+    # re-index the three candidate tables by the clamped slot
+    jj2 = jj.unsqueeze(-1).expand(-1, -1, 2)
+    vert_pts, extra_pts, int_pts = (torch.gather(x, 1, jj2) for x in (vert_pts, extra_pts, int_pts))
+    boundary = torch.where(has_verts.view(B, 1, 1), torch.where(is_vert.unsqueeze(-1), vert_pts, extra_pts),
+                           torch.zeros_like(extra_pts))
+    out = torch.where(is_bound.unsqueeze(-1), boundary, int_pts)
+    return out * (total > 0).view(B, 1, 1)
+
+
 def generate_deterministic_context_points_gpu(
     parent_verts_scaled: torch.Tensor | None,
     parent_bin:          torch.Tensor,
@@ -122,17 +413,35 @@ def generate_deterministic_context_points_gpu(
     N_boundary:          int,
     N_interior:          int
 ) -> torch.Tensor:
+    """Single-parent wrapper around generate_deterministic_context_points_gpu_batch, returns [N_total, 2]."""
+    device = parent_bin.device
+    if parent_verts_scaled is not None and parent_verts_scaled.size(0) >= 1:
+        verts = parent_verts_scaled.unsqueeze(0)
+        lengths = torch.full((1,), parent_verts_scaled.size(0), dtype=torch.long, device=device)
+    else:
+        verts, lengths = None, None
+    return generate_deterministic_context_points_gpu_batch(
+        verts, lengths, parent_bin.unsqueeze(0), N_total, N_boundary, N_interior
+    )[0]
+
+
+def _generate_deterministic_context_points_gpu_reference(
+    parent_verts_scaled: torch.Tensor | None,
+    parent_bin:          torch.Tensor,
+    N_total:             int,
+    N_boundary:          int,
+    N_interior:          int
+) -> torch.Tensor:
+    # Original list-building implementation, kept as the oracle for check_context_points_gpu
     device = parent_bin.device
     dtype = torch.float32
     pts = []
     # 1) Boundary sampling: include each polygon vertex first
     if N_boundary > 0 and parent_verts_scaled is not None and parent_verts_scaled.size(0) >= 1:
         V = parent_verts_scaled.to(device=device, dtype=dtype)
-        # Add each vertex
         pts.extend(V.cpu().tolist())
         extra = N_boundary - V.size(0)
         if extra > 0:
-            # Distribute extra points along edges
             edges = torch.cat([V, V[0:1]], dim=0)
             vecs = edges[1:] - edges[:-1]
             lens = vecs.norm(dim=1)
@@ -141,8 +450,7 @@ def generate_deterministic_context_points_gpu(
             cum = torch.cat([torch.zeros(1,device=device,dtype=dtype), lens.cumsum(dim=0)])
             idx = (torch.bucketize(dists, cum) - 1).clamp(0, lens.size(0)-1)
             t = (dists - cum[idx]) / (lens[idx] + 1e-12)
-            extra_pts = (V[idx] + vecs[idx] * t.unsqueeze(1)).cpu().tolist()
-            pts.extend(extra_pts)
+            pts.extend((V[idx] + vecs[idx] * t.unsqueeze(1)).cpu().tolist())
     else:
         pts.extend([[0.0, 0.0]] * N_boundary)
 
@@ -155,14 +463,12 @@ def generate_deterministic_context_points_gpu(
         xx, yy = torch.meshgrid(xs, ys, indexing='xy')
         cand = torch.stack([xx.reshape(-1), yy.reshape(-1)], dim=1)
         ix, jx = cand[:,1].long(), cand[:,0].long()
-        inside = parent_bin[ix, jx] > 0
-        valid = cand[inside]
+        valid = cand[parent_bin[ix, jx] > 0]
         Mv = valid.size(0)
         if Mv >= N_interior:
             sel = valid[:N_interior]
         else:
-            pad = valid[-1:].expand(N_interior - Mv, 2)
-            sel = torch.cat([valid, pad], dim=0)
+            sel = torch.cat([valid, valid[-1:].expand(N_interior - Mv, 2)], dim=0)
         sel = sel.cpu().numpy()
         sel[:,0] = sel[:,0] / (W - 1 + 1e-9)
         sel[:,1] = sel[:,1] / (H - 1 + 1e-9)
@@ -177,6 +483,49 @@ def generate_deterministic_context_points_gpu(
     pts = pts[:N_total]
     return torch.tensor(pts, dtype=torch.float32, device=device)
 
+
+def check_context_points_gpu(trials: int = 300, seed: int = 0, device: str = "cpu") -> List[int]:
+    """
+    Compares generate_deterministic_context_points_gpu and
+    generate_deterministic_context_points_gpu_batch (allclose, atol 1e-5) with
+    per-parent _generate_deterministic_context_points_gpu_reference calls on
+    seeded random masks and vertex sets. Parents the reference itself cannot
+    handle (it raises when no grid point lands inside the mask, or when nothing
+    is sampled at all) are dropped. Returns the failing trial indices.
+    """
+    rng = np.random.default_rng(seed)
+    H, W = 48, 64
+    failures, checked = [], 0
+    for trial in range(trials):
+        Nt, Nb, Ni = int(rng.integers(1, 60)), int(rng.integers(0, 20)), int(rng.integers(0, 40))
+        cases, ref = [], []
+        for _ in range(int(rng.integers(1, 6))):
+            v, mk = _random_context_case(rng, H, W)
+            v, mk = None if v is None else torch.from_numpy(v).to(device), torch.from_numpy(mk).to(device)
+            try:
+                ref.append(_generate_deterministic_context_points_gpu_reference(v, mk, Nt, Nb, Ni))
+            except (IndexError, RuntimeError):
+                continue
+            cases.append((v, mk))
+        if not cases:
+            continue
+        checked += 1
+        ok = all(torch.allclose(generate_deterministic_context_points_gpu(v, mk, Nt, Nb, Ni), r, atol=1e-5)
+                 for (v, mk), r in zip(cases, ref))
+        # The batch entry point takes padded vertex tensors; it is only compared when every parent has vertices
+        if ok and Nb > 0 and all(v is not None and len(v) for v, _ in cases):
+            lengths = torch.tensor([len(v) for v, _ in cases], device=device)
+            verts = torch.zeros(len(cases), int(lengths.max()), 2, device=device)
+            for i, (v, _) in enumerate(cases):
+                verts[i, :len(v)] = v
+            got = generate_deterministic_context_points_gpu_batch(
+                verts, lengths, torch.stack([mk for _, mk in cases]), Nt, Nb, Ni)
+            ok = got.shape == (len(cases), Nt, 2) and torch.allclose(got, torch.stack(ref), atol=1e-5)
+        if not ok:
+            failures.append(trial)
+    print(f"GPU context points vs reference: {len(failures)} of {checked} checked trials differ ({trials - checked} skipped)")
+    return failures
+
 def load_mask_np(mask_path):
     img = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)
     _, binary = cv2.threshold(img, 127, 255, cv2.THRESH_BINARY)
@@ -221,8 +570,70 @@ def mask_to_spline_points(mask_np, W, H, num_samples, smoothing):
 
 from scipy.optimize import minimize
 
-# --- (1) Bézier fitting helper ---
+# --- (1) Bézier fitting helpers ---
+@functools.lru_cache(maxsize=256)
+def bernstein_matrix(n_points: int, degree: int) -> np.ndarray:
+    """[n_points, degree+1] Bernstein basis sampled at t = linspace(0, 1, n_points). Read-only."""
+    t = np.linspace(0, 1, n_points)[:, None]
+    k = np.arange(degree + 1)[None, :]
+    binom = np.array([math.comb(degree, i) for i in range(degree + 1)], dtype=np.float64)
+    B = binom * t**k * (1 - t)**(degree - k)
+    B.setflags(write=False)
+    return B
+
+
+@functools.lru_cache(maxsize=256)
+def _interior_pinv(n_points: int, degree: int) -> np.ndarray:
+    # pseudo-inverse of the interior control-point columns, [degree-1, n_points]
+    P = np.linalg.pinv(bernstein_matrix(n_points, degree)[:, 1:-1])
+    P.setflags(write=False)
+    return P
+
+
+def fit_bezier_lstsq(segments: np.ndarray, degree: int = 2) -> np.ndarray:
+    """
+    Closed-form least-squares Bézier fit with fixed endpoints.
+
+    segments: [S, n, 2] stack of segments with the same point count (or one [n, 2]).
+    Returns control points [S, degree+1, 2] (or [degree+1, 2]); the first and last
+    are the segment endpoints. The interior points are solved as offsets from the
+    straight chord, so degenerate segments (n <= degree) collapse to a line.
+    """
+    pts = np.asarray(segments, dtype=np.float64)
+    single = pts.ndim == 2
+    if single:
+        pts = pts[None]
+    S, n, _ = pts.shape
+    p0, pn = pts[:, :1], pts[:, -1:]                                   # [S,1,2]
+    t = np.linspace(0, 1, n)[None, :, None]
+    resid = pts - (p0 + (pn - p0) * t)                                 # deviation from the chord
+    delta = np.einsum('kn,snd->skd', _interior_pinv(n, degree), resid)  # [S, degree-1, 2]
+    frac = (np.arange(1, degree) / degree)[None, :, None]
+    interior = p0 + (pn - p0) * frac + delta   # chord control points are the degree-elevated line
+    ctrl = np.concatenate([p0, interior, pn], axis=1)
+    return ctrl[0] if single else ctrl
+
+
+def fit_bezier_segments(segments: List[np.ndarray], degree: int = 2) -> List[np.ndarray]:
+    """Fits many variable-length segments, one fit_bezier_lstsq call per distinct length."""
+    out = [None] * len(segments)
+    by_len: Dict[int, List[int]] = {}
+    for i, seg in enumerate(segments):
+        by_len.setdefault(len(seg), []).append(i)
+    for idxs in by_len.values():
+        ctrl = fit_bezier_lstsq(np.stack([segments[i] for i in idxs]), degree)
+        for i, c in zip(idxs, ctrl):
+            out[i] = c
+    return out
+
+
 def fit_quadratic_bezier(points):
+    p0, p2 = points[0], points[-1]
+    return p0, fit_bezier_lstsq(points, degree=2)[1], p2
+
+
+def fit_quadratic_bezier_powell(points):
+    # Reference iterative fit (sum of point distances); fit_quadratic_bezier stays within tolerance of it
     p0, p2 = points[0], points[-1]
     def loss(p1_flat):
         p1 = p1_flat.reshape(2)
@@ -246,33 +657,130 @@ def find_max_deviation_point(segment):
     if L<1e-8: return None, 0.0
     unit = chord / L
     normal = np.array([-unit[1], unit[0]])
-    devs = [abs(np.dot((pt-p0), normal)) for pt in segment]
+    devs = np.abs((segment - p0) @ normal)
     idx = int(np.argmax(devs))
     return idx, devs[idx]
 
-# --- (3) Recursive splitter & fitter ---
+# --- (3) Iterative splitter & fitter ---
 def split_and_fit(segment, threshold_complex=1.01, threshold_dev=.5):
-    """Return a list of (p0, ctrl, p2, type_flag) for this segment."""
-    # Base straight‐line check
+    """
+    Return a list of (p0, ctrl, p2, type_flag) for this segment.
+
+    Works breadth-wise on inclusive [start, end] index ranges into `segment`:
+    each pass scores complexity and max deviation of every pending range in one
+    vectorized step, so long contours never hit the recursion limit. Leaves come
+    out in contour order, exactly like the original depth-first recursion, and
+    all curved leaves are fitted together at the end.
+    """
+    segment = np.asarray(segment)
+    pts = segment.astype(np.float64)
+    seg_lens = np.linalg.norm(np.diff(pts, axis=0), axis=1)
+    cum_arc = np.concatenate([[0.0], np.cumsum(seg_lens)])   # arc length of [s, e] = cum_arc[e] - cum_arc[s]
+
+    leaves = []   # (start, end, type_flag)
+    starts = np.array([0]); ends = np.array([len(pts) - 1])
+    while starts.size:
+        # Complexity: arc / chord, 1.0 for degenerate chords
+        chord_vec = pts[ends] - pts[starts]
+        chord = np.linalg.norm(chord_vec, axis=1)
+        arc = cum_arc[ends] - cum_arc[starts]
+        comp = np.where(chord > 1e-8, arc / np.maximum(chord, 1e-8), 1.0)
+        straight = comp <= threshold_complex
+        for s_, e_ in zip(starts[straight], ends[straight]):
+            leaves.append((s_, e_, 0))      # too straight → one line
+        starts, ends, chord_vec, chord = starts[~straight], ends[~straight], chord_vec[~straight], chord[~straight]
+        if not starts.size:
+            break
+
+        # Max deviation from the chord for all remaining ranges at once
+        counts = ends - starts + 1
+        offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        owner = np.repeat(np.arange(starts.size), counts)
+        local = np.arange(counts.sum()) - offsets[owner]
+        unit = chord_vec / np.maximum(chord, 1e-8)[:, None]
+        normal = np.stack([-unit[:, 1], unit[:, 0]], axis=1)
+        # differences in the input dtype and a row-wise matmul, so values (and argmax ties)
+        # match find_max_deviation_point's np.dot bit for bit
+        rel = (segment[starts[owner] + local] - segment[starts[owner]]).astype(np.float64)
+        devs = np.abs(np.matmul(rel[:, None, :], normal[owner][:, :, None])[:, 0, 0])
+        max_dev = np.maximum.reduceat(devs, offsets)
+        hits = np.flatnonzero(devs == max_dev[owner])
+        _, first = np.unique(owner[hits], return_index=True)   # first argmax, like np.argmax
+        idx = local[hits[first]]
+
+        # not enough deviation to warrant split → one quadratic; otherwise split at idx
+        fit_one = (max_dev <= threshold_dev) | (idx == 0) | (idx == counts - 1)
+        for s_, e_ in zip(starts[fit_one], ends[fit_one]):
+            leaves.append((s_, e_, 1))
+        split = ~fit_one
+        mid = starts[split] + idx[split]
+        starts = np.concatenate([starts[split], mid])
+        ends = np.concatenate([mid, ends[split]])
+
+    # Leaves never share a start index, so sorting by it restores contour order
+    leaves.sort(key=lambda leaf: leaf[0])
+    curved = [segment[s_:e_ + 1] for s_, e_, flag in leaves if flag == 1]
+    ctrls = iter(fit_bezier_segments(curved, degree=2))
+    out = []
+    for s_, e_, flag in leaves:
+        if flag == 0:
+            out.append((segment[s_], segment[s_], segment[e_], 0))  # type=0 for straight
+        else:
+            out.append((segment[s_], next(ctrls)[1], segment[e_], 1))  # type=1 for curve
+    return out
+
+
+def _split_and_fit_reference(segment, threshold_complex=1.01, threshold_dev=.5):
+    # Original recursive splitter (per-point deviation loop), kept as the oracle for check_split_and_fit
     comp = measure_complexity(segment)
     if comp <= threshold_complex:
-        # too straight → one line
         p0, p2 = segment[0], segment[-1]
-        return [ (p0, p0, p2, 0) ]  # type=0 for straight
-
-    # find max deviation
-    idx, dev = find_max_deviation_point(segment)
+        return [ (p0, p0, p2, 0) ]
+    p0, p1 = segment[0], segment[-1]
+    chord = p1 - p0
+    L = np.linalg.norm(chord)
+    if L < 1e-8:
+        idx, dev = None, 0.0
+    else:
+        unit = chord / L
+        normal = np.array([-unit[1], unit[0]])
+        devs = [abs(np.dot((pt-p0), normal)) for pt in segment]
+        idx = int(np.argmax(devs))
+        dev = devs[idx]
     if dev <= threshold_dev or idx in (0, len(segment)-1):
-        # not enough deviation to warrant split → fit one quadratic
         a,b,c = fit_quadratic_bezier(segment)
-        return [ (a, b, c, 1) ]  # type=1 for curve
-
-    # otherwise, split at idx and recurse
-    first  = split_and_fit(segment[:idx+1], threshold_complex, threshold_dev)
-    second = split_and_fit(segment[idx:],   threshold_complex, threshold_dev)
+        return [ (a, b, c, 1) ]
+    first  = _split_and_fit_reference(segment[:idx+1], threshold_complex, threshold_dev)
+    second = _split_and_fit_reference(segment[idx:],   threshold_complex, threshold_dev)
     return first + second
 
 
+def check_split_and_fit(trials: int = 150, seed: int = 0) -> List[int]:
+    """
+    Runs split_and_fit and _split_and_fit_reference on seeded random noisy
+    loops (float64, int32-rounded and float32 points) and returns the trial
+    indices whose outputs differ: segment types and endpoints must match
+    exactly, control points within allclose.
+    """
+    rng = np.random.default_rng(seed)
+    failures = []
+    for trial in range(trials):
+        n = int(rng.integers(3, 400))
+        th = np.sort(rng.uniform(0, 2*np.pi, n))
+        r = 50 + rng.normal(0, 5, n).cumsum() * 0.3
+        pts = np.stack([r*np.cos(th), r*np.sin(th)], 1)
+        if trial % 3 == 1: pts = np.round(pts).astype(np.int32)
+        if trial % 3 == 2: pts = pts.astype(np.float32)
+        ref, got = _split_and_fit_reference(pts), split_and_fit(pts)
+        same = len(ref) == len(got) and all(
+            a[3] == b[3] and np.array_equal(a[0], b[0]) and np.array_equal(a[2], b[2]) and np.allclose(a[1], b[1])
+            for a, b in zip(ref, got))
+        if not same:
+            failures.append(trial)
+    print(f"split_and_fit vs reference: {len(failures)} of {trials} trials differ")
+    return failures
+
+
 def check_context_point_validity(context_points, parent_bin, sx, sy):
     """
     Checks which context points fall inside the binary parent mask.
@@ -291,6 +799,28 @@ def check_context_point_validity(context_points, parent_bin, sx, sy):
     mask_values = parent_bin[ys, xs] > 0
     return mask_values  # boolean array of length N
 
+def check_context_point_validity_batch(context_points, parent_bins, sx, sy):
+    """
+    Torch-native, batched version of check_context_point_validity.
+
+    Args:
+        context_points (Tensor): [B, N, 2] in scaled space
+        parent_bins (Tensor): [B, H, W] binary masks (any dtype, > 0 means inside)
+        sx, sy (float or Tensor [B]): scaling factors for x and y
+    Returns:
+        validity_mask (Tensor): [B, N] bool, on the device of parent_bins
+    """
+    B, H, W = parent_bins.shape
+    pts = context_points.to(device=parent_bins.device, dtype=torch.float32)
+    sx = torch.as_tensor(sx, dtype=torch.float32, device=pts.device).reshape(-1, 1)
+    sy = torch.as_tensor(sy, dtype=torch.float32, device=pts.device).reshape(-1, 1)
+
+    # same truncate-then-clip pixel lookup as the NumPy version
+    xs = (pts[..., 0] / sx * W).long().clamp(0, W - 1)
+    ys = (pts[..., 1] / sy * H).long().clamp(0, H - 1)
+    flat = parent_bins.reshape(B, H * W) > 0
+    return flat.gather(1, ys * W + xs)  # [B, N]
+
 def visualize_context_with_mask(context_points, parent_bin, sx, sy):
     validity = check_context_point_validity(context_points, parent_bin, sx, sy)
     points = context_points.clone().detach().cpu().numpy()
@@ -334,6 +864,7 @@ def save_visualization(pts, mismatches, mask_path, out_path="mask_sampling_debug
     print(f"Saved visualization to {out_path}")
 import os
 import json
+import hashlib
 from typing import Optional
 
 import cv2
@@ -347,6 +878,381 @@ from contour import mask_to_bezier_sequence
 from transformers import AutoTokenizer, T5EncoderModel
 
 
+# Process-wide FLAN-T5 registry: model name -> (tokenizer, frozen encoder stack)
+_T5_REGISTRY: Dict[str, Tuple[object, nn.Module]] = {}
+
+
+def get_t5_encoder(model_name: str = "google/flan-t5-base"):
+    """
+    Returns the shared (tokenizer, frozen T5 encoder stack) for `model_name`,
+    loading it on first use. AugmentedDataset and PolygonPredictor both go
+    through here, so a process never holds two copies of the same encoder.
+    """
+    if model_name not in _T5_REGISTRY:
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        encoder = T5EncoderModel.from_pretrained(model_name).encoder.eval()
+        for p in encoder.parameters(): p.requires_grad = False
+        _T5_REGISTRY[model_name] = (tokenizer, encoder)
+    return _T5_REGISTRY[model_name]
+
+
+def unload_t5_encoder(model_name: Optional[str] = None) -> None:
+    """
+    Drops the registry's reference to one encoder (or all of them when
+    model_name is None). Memory is only freed once no model still holds it.
+    """
+    names = list(_T5_REGISTRY) if model_name is None else [model_name]
+    for name in names:
+        _T5_REGISTRY.pop(name, None)
+    import gc
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+class T5EmbeddingCache:
+    """
+    Content-addressed on-disk store for frozen FLAN-T5 sequence embeddings.
+
+    Entries are keyed by (model name, text_max_length, sha256 of the text) and
+    hold only the non-padding token states [L, hidden], so one file per unique
+    description is shared by every dataset build that uses the same encoder.
+    """
+    def __init__(self, cache_dir: str, model_name: str, text_max_length: int):
+        self.cache_dir = cache_dir
+        self.model_name = model_name
+        self.text_max_length = int(text_max_length)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, text: str) -> str:
+        text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        raw = f"{self.model_name}|{self.text_max_length}|{text_hash}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        # two-level fan-out keeps directory listings small for large corpora
+        return os.path.join(self.cache_dir, key[:2], f"{key}.pt")
+
+    def get(self, text: str) -> Optional[torch.Tensor]:
+        path = self._path(self.key(text))
+        if not os.path.exists(path):
+            return None
+        try:
+            return torch.load(path, map_location="cpu")
+        except Exception as e:
+            print(f"Warning: corrupt embedding cache entry {path}: {e}. Re-encoding.")
+            return None
+
+    def put(self, text: str, seq: torch.Tensor) -> None:
+        path = self._path(self.key(text))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        torch.save(seq.detach().cpu().contiguous(), tmp_path)
+        os.replace(tmp_path, path)  # atomic, so concurrent builds never see partial files
+
+
+def pad_text_sequence(seq: torch.Tensor, max_length: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Zero-pads a [L, hidden] token sequence to [max_length, hidden] and returns it with its [max_length] bool mask."""
+    L = min(seq.size(0), max_length)
+    padded = torch.zeros((max_length, seq.size(1)), dtype=seq.dtype)
+    padded[:L] = seq[:L]
+    mask = torch.zeros(max_length, dtype=torch.bool)
+    mask[:L] = True
+    return padded, mask
+
+
+def _bezier_from_mask(mask_sq: np.ndarray, epsilon: float) -> np.ndarray:
+    _, segs = mask_to_bezier_sequence(
+        mask_sq, max_ctrl=2, dev_thresh=0,
+        epsilon_ratio=epsilon, merge_thresh=0.01, angle_thresh_deg=1
+    )
+    return np.asarray(segs, dtype=np.float32).reshape(-1, 6)
+
+
+# Part of every geometry cache key: bump whenever mask decoding or the Bézier
+# fitting changes, so entries computed by older code are never reused.
+# 1: ROI fitting on 127-thresholded masks
+# 2: fitted points clamped to >= 0
+# 3: full-frame fitting by default, ROI fitting opt-in (roi_geometry)
+GEOMETRY_VERSION = 3
+
+
+class GeometryCache:
+    """
+    Content-addressed on-disk store for mask geometry: each entry is a dict of
+    numpy arrays saved as one .npz, keyed by a hash of the mask file bytes, the
+    fitting parameters and GEOMETRY_VERSION (see _mask_geometry_key). Clear it
+    if contour.py changes.
+    """
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.npz")
+
+    def get(self, key: str) -> Optional[Dict[str, np.ndarray]]:
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path) as data:
+                return {k: data[k] for k in data.files}
+        except Exception as e:
+            print(f"Warning: corrupt geometry cache entry {path}: {e}. Recomputing.")
+            return None
+
+    def put(self, key: str, arrays: Dict[str, np.ndarray]) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path[:-4]}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+
+def _mask_geometry_key(kind: str, mask_path: Optional[str], W: int, H: int, epsilon: float) -> str:
+    """Hash of the mask bytes (None = full-image parent) plus everything the fit depends on."""
+    h = hashlib.sha256(f"v{GEOMETRY_VERSION}|{kind}|{W}x{H}|{epsilon!r}".encode("utf-8"))
+    if mask_path is not None:
+        with open(mask_path, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def _roi_bezier(roi: np.ndarray, x: int, y: int, epsilon: float) -> np.ndarray:
+    """
+    Bézier segments [K,6] of the mask crop `roi` whose top-left pixel is (x, y),
+    returned in full-image pixel coordinates.
+
+    The ROI gets a 1-pixel zero border so contours never touch the crop edge;
+    fitted points are translated back afterwards (-1 sentinel pairs are kept).
+    This relies on mask_to_bezier_sequence being translation invariant (its
+    epsilon is relative to the contour, not the image), which is why ROI
+    fitting is opt-in (AugmentedDataset(roi_geometry=True)); check_roi_geometry
+    compares against the full-frame fit.
+    """
+    roi = cv2.copyMakeBorder(roi, 1, 1, 1, 1, cv2.BORDER_CONSTANT, value=0)
+    segs = _bezier_from_mask(roi, epsilon)
+    pts = segs.reshape(-1, 3, 2)
+    present = ~np.all(pts == -1, axis=-1)
+    pts[present] += np.array([x - 1, y - 1], dtype=np.float32)
+    return _clamp_present_points(segs)
+
+
+def _clamp_present_points(segs: np.ndarray) -> np.ndarray:
+    """
+    Clamps the real points of [K,6] segments to >= 0 in place (-1 sentinel pairs
+    are kept). Downstream, any negative coordinate reads as "absent", so a
+    control point overshooting the image edge (possibly onto exactly (-1, -1))
+    would otherwise be dropped.
+    """
+    pts = segs.reshape(-1, 3, 2)
+    present = ~np.all(pts == -1, axis=-1)
+    pts[present] = np.maximum(pts[present], 0.0)
+    return segs
+
+
+def _mask_roi_geometry(mask: np.ndarray, epsilon: float):
+    """
+    Bézier segments [K,6] and bbox (x_min, y_min, x_max, y_max) of a binary mask,
+    both in full-image pixel coordinates, computed on the tight bounding ROI only.
+    Returns None for an empty mask.
+    """
+    x, y, w, h = cv2.boundingRect(mask)
+    if w == 0 or h == 0:
+        return None
+    return _roi_bezier(mask[y:y + h, x:x + w], x, y, epsilon), (x, y, x + w - 1, y + h - 1)
+
+
+def _letterboxed_bezier(mask: np.ndarray, epsilon: float) -> np.ndarray:
+    """Fit on the full letterboxed canvas like the original pipeline (the default, and for empty masks)."""
+    H, W = mask.shape
+    canvas = max(W, H)
+    mask_sq = np.zeros((canvas, canvas), np.uint8)
+    mask_sq[:H, :W] = mask
+    return _bezier_from_mask(mask_sq, epsilon)
+
+
+def _load_resized_mask(mask_path: Optional[str], W: int, H: int) -> np.ndarray:
+    """
+    Binary 0/255 mask resized to (W, H) with nearest neighbour; None = the whole
+    image (all 255). Thresholded at 127 like load_mask_np, so anti-aliased edge
+    pixels (1..127) stay background in every geometry path.
+    """
+    if mask_path is None:
+        return np.full((H, W), 255, np.uint8)
+    resized = cv2.resize(
+        cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE),
+        (W, H), interpolation=cv2.INTER_NEAREST
+    )
+    _, binary = cv2.threshold(resized, 127, 255, cv2.THRESH_BINARY)
+    return binary
+
+
+def check_roi_geometry(root_dir: str = "dataset", epsilon: float = 0.01, atol: float = 1e-3,
+                       masks_dir: str = "masks", images_dir: str = "images") -> List[Tuple[str, float]]:
+    """
+    Fits every mask under root_dir/masks/<scene>/ on its tight ROI (the
+    preprocessing path) and on the full letterboxed canvas (the original
+    pipeline), and returns (mask path, max abs coordinate difference) for each
+    mask whose fits differ by more than `atol` (inf if the segment counts
+    differ). Run it after changing contour.py or the epsilon ratio.
+    """
+    mismatches, checked = [], 0
+    for fn in sorted(os.listdir(os.path.join(root_dir, images_dir))):
+        if not fn.endswith('.png'): continue
+        scene_masks = os.path.join(root_dir, masks_dir, fn[:-4])
+        if not os.path.isdir(scene_masks): continue
+        W, H = Image.open(os.path.join(root_dir, images_dir, fn)).size
+        for mname in sorted(os.listdir(scene_masks)):
+            path = os.path.join(scene_masks, mname)
+            mask = _load_resized_mask(path, W, H)
+            geo = _mask_roi_geometry(mask, epsilon)
+            if geo is None: continue
+            roi_segs = geo[0]
+            full_segs = _clamp_present_points(_letterboxed_bezier(mask, epsilon))
+            checked += 1
+            if roi_segs.shape != full_segs.shape:
+                mismatches.append((path, float('inf')))
+                continue
+            diff = float(np.abs(roi_segs - full_segs).max()) if roi_segs.size else 0.0
+            if diff > atol:
+                mismatches.append((path, diff))
+    print(f"ROI vs full-frame fit: {len(mismatches)} of {checked} masks differ (atol={atol})")
+    for path, diff in mismatches:
+        print(f"  {path}: max |diff| = {diff}")
+    return mismatches
+
+
+_PLANE_DTYPES = ((8, np.uint8), (16, np.uint16), (32, np.uint32), (64, np.uint64))
+
+
+class MaskPlanes:
+    """
+    Bit-plane stack of all masks of one scene: mask k is bit k % 64 of plane k // 64
+    (planes use the smallest unsigned dtype that holds their masks). Masks may
+    overlap, which rules out a plain label map.
+
+    Every mask is decoded and resized exactly once; bboxes of all masks come from
+    one OR-reduction over rows and columns per plane, and contours are then
+    extracted per mask on its ROI only.
+    """
+    def __init__(self, mask_paths: List[Optional[str]], W: int, H: int):
+        self.planes = []
+        for start in range(0, len(mask_paths), 64):
+            chunk = mask_paths[start:start + 64]
+            dtype = next(dt for bits, dt in _PLANE_DTYPES if len(chunk) <= bits)
+            plane = np.zeros((H, W), dtype)
+            for bit, path in enumerate(chunk):
+                m = _load_resized_mask(path, W, H) > 0
+                plane |= m.astype(dtype) << dtype(bit)
+            self.planes.append(plane)
+        self.bboxes = self._bboxes(len(mask_paths))
+
+    def _bboxes(self, K: int) -> List[Optional[Tuple[int, int, int, int]]]:
+        out = []
+        for plane in self.planes:
+            dtype = plane.dtype.type
+            rows = np.bitwise_or.reduce(plane, axis=1)  # [H]
+            cols = np.bitwise_or.reduce(plane, axis=0)  # [W]
+            for bit in range(min(K - len(out), 64)):
+                ys = np.flatnonzero((rows >> dtype(bit)) & dtype(1))
+                xs = np.flatnonzero((cols >> dtype(bit)) & dtype(1))
+                out.append((int(xs[0]), int(ys[0]), int(xs[-1]), int(ys[-1])) if ys.size else None)
+        return out
+
+    def mask(self, k: int, bbox: Optional[Tuple[int, int, int, int]] = None) -> np.ndarray:
+        """uint8 0/255 mask k, cropped to bbox (inclusive x_min, y_min, x_max, y_max) if given."""
+        plane = self.planes[k // 64]
+        dtype = plane.dtype.type
+        if bbox is not None:
+            x0, y0, x1, y1 = bbox
+            plane = plane[y0:y1 + 1, x0:x1 + 1]
+        return ((plane >> dtype(k % 64)) & dtype(1)).astype(np.uint8) * 255
+
+    def bezier(self, k: int, epsilon: float, roi: bool = False) -> np.ndarray:
+        """
+        Bézier segments [K,6] of mask k in full-image pixel coordinates, fitted on
+        the full letterboxed canvas like the original pipeline, or on the mask's
+        tight ROI with roi=True (see _roi_bezier).
+        """
+        bbox = self.bboxes[k]
+        if roi and bbox is not None:
+            return _roi_bezier(self.mask(k, bbox), bbox[0], bbox[1], epsilon)
+        return _clamp_present_points(_letterboxed_bezier(self.mask(k), epsilon))
+
+
+def _normalize_parent(p_segs: np.ndarray, bbox: Optional[Tuple[int, int, int, int]], canvas: int) -> Dict[str, np.ndarray]:
+    """Parent dict from pixel-space segments and bbox (None = empty mask, full canvas)."""
+    if bbox is not None:
+        x_min, y_min, x_max, y_max = bbox
+    else:
+        x_min, y_min, x_max, y_max = 0,0,canvas-1,canvas-1
+    bbox = np.array([
+        [x_min,y_min], [x_min,y_max],
+        [x_max,y_min], [x_max,y_max]
+    ], dtype=np.float32) / np.float32(canvas - 1)
+    p_segs = p_segs.copy()
+    p_segs[p_segs>=0] /= np.float32(canvas - 1)
+    return {'parent_bbox': bbox, 'parent_bezier': p_segs}
+
+
+def _scene_geometry(task) -> List[Dict]:
+    """
+    Geometry for every raw entry of one scene (picklable, for process pools):
+    parent bbox [4,2], normalized parent Bézier [K_p,6], child GT [K_c,6] and
+    length K_c, as float32 numpy arrays (unpadded, any number of segments).
+
+    All masks of the scene (children and parents not found in the cache) are
+    decoded once into a MaskPlanes stack and every unique mask is fitted once,
+    whether it is used as child, parent or both; with a cache_dir parent
+    geometry also persists across builds.
+    """
+    infos, images_dir, epsilon, cache_dir, roi_geometry = task
+    cache = GeometryCache(cache_dir) if cache_dir else None
+    # every entry of a scene shares the same image size
+    img = Image.open(os.path.join(images_dir, f"{infos[0]['scene']}.png"))
+    W, H = img.size; canvas = max(W, H)
+
+    parent_of = [None if info['parent_is_image'] else info['parent_mask'] for info in infos]
+    parents, parent_keys = {}, {}
+    for parent_mask in dict.fromkeys(parent_of):
+        if cache:
+            kind = "parent_packed_roi" if roi_geometry else "parent_packed"
+            parent_keys[parent_mask] = _mask_geometry_key(kind, parent_mask, W, H, epsilon)
+            geo = cache.get(parent_keys[parent_mask])
+            if geo is not None:
+                parents[parent_mask] = geo
+
+    # one decode + one fit per unique mask still needed
+    needed = list(dict.fromkeys(
+        [info['child_mask'] for info in infos] + [p for p in parent_of if p not in parents]
+    ))
+    stack = MaskPlanes(needed, W, H)
+    shapes = {path: (stack.bezier(k, epsilon, roi=roi_geometry), stack.bboxes[k]) for k, path in enumerate(needed)}
+    del stack
+
+    for parent_mask in dict.fromkeys(parent_of):
+        if parent_mask not in parents:
+            parents[parent_mask] = _normalize_parent(*shapes[parent_mask], canvas)
+            if cache:
+                cache.put(parent_keys[parent_mask], parents[parent_mask])
+
+    out = []
+    for info, parent_mask in zip(infos, parent_of):
+        parent_geo = parents[parent_mask]
+        # child GT
+        gt = shapes[info['child_mask']][0].copy()
+        gt[gt>=0] /= np.float32(canvas - 1)
+        out.append({
+            'parent_bbox': parent_geo['parent_bbox'],
+            'parent_bezier': parent_geo['parent_bezier'],
+            'gt_curves': gt,
+            'lengths': gt.shape[0],
+        })
+    return out
+
+
 class AugmentedDataset(Dataset):
     """
     Loads scenes, computes:
@@ -354,6 +1260,25 @@ class AugmentedDataset(Dataset):
       - parent_bbox corners [4,2]
       - normalized parent Bézier segments
       - normalized child Bézier GT curves
+
+    Samples are stored as per-field [N, ...] tensors, packed (values, offsets)
+    Bézier sequences of any length and a table of unique text embeddings;
+    __getitems__ returns a collated batch via index_select, so the
+    DataLoader skips per-sample dicts (collate_fn passes such batches through).
+
+    With text_storage="pooled" only the attention-mask-aware mean [hidden] of
+    each description is kept instead of the [512, hidden] sequence and mask.
+
+    Unique descriptions are encoded up front in length-sorted batches of
+    `text_batch_size`. If `embedding_cache_dir` is given, text embeddings are
+    read from / written to a T5EmbeddingCache; the encoder is only loaded when
+    a description misses. Mask geometry runs per scene, across `num_workers`
+    processes when > 0; each mask of a scene is decoded and fitted once (see
+    MaskPlanes) and parent geometry is shared by all children of a parent
+    and, with `geometry_cache_dir`, persisted in a GeometryCache.
+    `roi_geometry=True` fits each mask on its tight ROI instead of the full
+    canvas; enable it only once check_roi_geometry reports no mismatches with
+    the contour.py in use.
     """
     def __init__(
         self,
@@ -364,14 +1289,27 @@ class AugmentedDataset(Dataset):
         max_samples: int = None,
         poly_epsilon_ratio: float = 0.01,
         text_max_length: int = 512,
+        t5_model_name: str = "google/flan-t5-base",
+        embedding_cache_dir: Optional[str] = None,
+        text_batch_size: int = 64,
+        text_storage: str = "sequence",
+        num_workers: int = 0,
+        geometry_cache_dir: Optional[str] = None,
+        roi_geometry: bool = False,
     ):
         super().__init__()
-        # FLAN-T5 setup for sequence embeddings
-        self.tokenizer = AutoTokenizer.from_pretrained("google/flan-t5-base")
-        self.encoder = T5EncoderModel.from_pretrained("google/flan-t5-base").encoder.eval()
-        for p in self.encoder.parameters(): p.requires_grad = False
+        if text_storage not in ("sequence", "pooled"):
+            raise ValueError(f"text_storage must be 'sequence' or 'pooled', got {text_storage!r}")
+        # FLAN-T5 for sequence embeddings comes from the shared registry, only on a cache miss
+        self.t5_model_name = t5_model_name
         self.text_max_length = text_max_length
-        self.hidden_size = self.encoder.config.hidden_size
+        self.text_batch_size = int(text_batch_size)
+        self.text_storage = text_storage
+        self.hidden_size = None
+        self.embedding_cache = (
+            T5EmbeddingCache(embedding_cache_dir, t5_model_name, text_max_length)
+            if embedding_cache_dir else None
+        )
         self.epsilon = float(poly_epsilon_ratio)
 
         # Paths
@@ -421,158 +1359,672 @@ class AugmentedDataset(Dataset):
             if max_samples and len(raw) >= max_samples:
                 break
 
-        # Precompute all samples
-        self.samples = []
+        # Text embeddings: every unique description is encoded at most once, in batches
+        unique_texts = list(dict.fromkeys(
+            t for info in raw for t in (info['child_desc'], info['parent_desc'])
+        ))
+        text_embs = self._resolve_text_embeddings(unique_texts)
+        # text table (unique descriptions, in order) + per-sample (child, parent) rows
+        text_table = [text_embs[t] for t in unique_texts]
+        text_row = {t: i for i, t in enumerate(unique_texts)}
+        sample_texts = [(text_row[info['child_desc']], text_row[info['parent_desc']]) for info in raw]
+
+        # Geometry: one task per scene, in a process pool when num_workers > 0.
+        # Scenes are submitted in order and map() preserves it, so the output matches the serial path.
+        scene_tasks = {}
         for info in raw:
-            # load image for bbox
-            img = Image.open(os.path.join(self.images_dir, f"{info['scene']}.png"))
-            W, H = img.size; canvas = max(W, H)
-            # child mask
-            child_bin = cv2.resize(
-                cv2.imread(info['child_mask'], cv2.IMREAD_GRAYSCALE),
-                (W, H), interpolation=cv2.INTER_NEAREST
-            )
-            # parent mask or white
-            if not info['parent_is_image']:
-                pm = cv2.resize(
-                    cv2.imread(info['parent_mask'], cv2.IMREAD_GRAYSCALE),
-                    (W, H), interpolation=cv2.INTER_NEAREST
-                )
-            else:
-                pm = np.ones((H, W), np.uint8) * 255
-            # letterbox
-            mask_sq = np.zeros((canvas, canvas), np.uint8)
-            mask_sq[:H, :W] = pm
-            # bbox
-            ys, xs = np.where(mask_sq > 0)
-            if xs.size>0:
-                x_min, x_max = xs.min(), xs.max()
-                y_min, y_max = ys.min(), ys.max()
-            else:
-                x_min, y_min, x_max, y_max = 0,0,canvas-1,canvas-1
-            bbox = torch.tensor([
-                [x_min,y_min], [x_min,y_max],
-                [x_max,y_min], [x_max,y_max]
-            ], dtype=torch.float32) / float(canvas - 1)
-            # parent bezier
-            _, p_segs_raw = mask_to_bezier_sequence(
-                mask_sq, max_ctrl=2, dev_thresh=0,
-                epsilon_ratio=self.epsilon, merge_thresh=0.01, angle_thresh_deg=1
-            )
-            p_segs = torch.tensor(p_segs_raw, dtype=torch.float32)
-            p_segs[p_segs>=0] /= float(canvas - 1)
-            pad_len = 30 - p_segs.size(0)
-            pad_tensor = -1 * torch.ones((pad_len, 6), dtype=p_segs.dtype, device=p_segs.device)
-            p_segs= torch.cat([p_segs, pad_tensor], dim=0)
-            # child GT
-            mask_sq[:,:] = 0; mask_sq[:H,:W] = child_bin
-            _, c_segs_raw = mask_to_bezier_sequence(
-                mask_sq, max_ctrl=2, dev_thresh=0,
-                epsilon_ratio=self.epsilon, merge_thresh=0.01, angle_thresh_deg=1
-            )
-            gt = torch.tensor(c_segs_raw, dtype=torch.float32)
-            gt[gt>=0] /= float(canvas - 1)
-            lengths = gt.size(0)
-            pad_len = 30 - gt.size(0)
-            pad_tensor = -1 * torch.ones((pad_len, 6), dtype=gt.dtype, device=gt.device)
-            gt = torch.cat([gt, pad_tensor], dim=0)
-            # text embeddings (sequence)
-            toks_c = self.tokenizer(
-                [info['child_desc']],
-                padding='max_length', truncation=True,
-                max_length=self.text_max_length,
-                return_tensors='pt'
-            )
-            toks_p = self.tokenizer(
-                [info['parent_desc']],
-                padding='max_length', truncation=True,
-                max_length=self.text_max_length,
-                return_tensors='pt'
+            scene_tasks.setdefault(info['scene'], []).append(info)
+        tasks = [(infos, self.images_dir, self.epsilon, geometry_cache_dir, roi_geometry) for infos in scene_tasks.values()]
+        if num_workers and num_workers > 0 and len(tasks) > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=num_workers) as ex:
+                scene_results = list(ex.map(_scene_geometry, tasks))
+        else:
+            scene_results = [_scene_geometry(t) for t in tasks]
+        geometry = [g for res in scene_results for g in res]
+
+        # Precompute all samples as contiguous per-field tensors (struct of arrays):
+        # [N, 4, 2] bboxes, [N] lengths and [N] rows into the [U, ...] text table,
+        # so a batch is one index_select per field. Parent Béziers and GT curves
+        # have any number of segments and are packed: ([sum K, 6] values, [N+1] offsets).
+        self.packed = {
+            'parent_bezier': _pack_rows([g['parent_bezier'] for g in geometry]),
+            'gt_curves':     _pack_rows([g['gt_curves'] for g in geometry]),
+        }
+        self.fields = {
+            'parent_bbox':   _stack_rows([g['parent_bbox'] for g in geometry], (4, 2)),
+            'lengths':       torch.tensor([g['lengths'] for g in geometry], dtype=torch.long),
+            'child_text':    torch.tensor([c for c, _ in sample_texts], dtype=torch.long),
+            'parent_text':   torch.tensor([p for _, p in sample_texts], dtype=torch.long),
+        }
+        if text_table:
+            self.text_embs = torch.stack([e for e, _ in text_table])  # [U, 512, H] or [U, H]
+            self.text_mask = (
+                torch.stack([m for _, m in text_table]) if self.text_storage == "sequence" else None
             )
-            # encode
+        else:
+            self.text_embs, self.text_mask = torch.zeros(0), None
+
+    def _encode_texts(self, texts: List[str]) -> List[torch.Tensor]:
+        """
+        Encodes many descriptions in length-sorted batches with dynamic padding.
+        Returns the non-padding states [L_i, H] for each text, in input order.
+        """
+        # No reference is kept, so unload_t5_encoder() can free it after the build
+        tokenizer, encoder = get_t5_encoder(self.t5_model_name)
+        enc_device = next(encoder.parameters()).device  # a shared model may have moved it
+        ids = tokenizer(texts, truncation=True, max_length=self.text_max_length)['input_ids']
+        pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+        # sorting by token count groups similar lengths, so each batch pads only to its own max
+        order = sorted(range(len(texts)), key=lambda i: len(ids[i]))
+        out = [None] * len(texts)
+        for start in range(0, len(order), self.text_batch_size):
+            chunk = order[start:start + self.text_batch_size]
+            L_max = len(ids[chunk[-1]])
+            input_ids = torch.full((len(chunk), L_max), pad_id, dtype=torch.long)
+            attention_mask = torch.zeros((len(chunk), L_max), dtype=torch.long)
+            for row, i in enumerate(chunk):
+                input_ids[row, :len(ids[i])] = torch.tensor(ids[i], dtype=torch.long)
+                attention_mask[row, :len(ids[i])] = 1
             with torch.no_grad():
-                enc_c = self.encoder(
-                    input_ids=toks_c.input_ids,
-                    attention_mask=toks_c.attention_mask
-                )
-                enc_p = self.encoder(
-                    input_ids=toks_p.input_ids,
-                    attention_mask=toks_p.attention_mask
-                )
-            seq_c = enc_c.last_hidden_state.squeeze(0)  # [512, H]
-            seq_p = enc_p.last_hidden_state.squeeze(0)
-            mask_c = toks_c.attention_mask.squeeze(0).bool()  # [512]
-            mask_p = toks_p.attention_mask.squeeze(0).bool()
-            # store
-            self.samples.append({
-                'child_embs': seq_c,
-                'child_mask': mask_c,
-                'parent_embs': seq_p,
-                'parent_mask': mask_p,
-                'parent_bbox': bbox,
-                'parent_bezier': p_segs,
-                'gt_curves': gt,
-                'lengths': lengths
-            })
-
-    def __len__(self): return len(self.samples)
-    
+                states = encoder(
+                    input_ids=input_ids.to(enc_device),
+                    attention_mask=attention_mask.to(enc_device)
+                ).last_hidden_state.cpu()
+            for row, i in enumerate(chunk):
+                out[i] = states[row, :len(ids[i])].clone()
+        return out
+
+    def _resolve_text_embeddings(self, texts: List[str]) -> Dict[str, Tuple[torch.Tensor, Optional[torch.Tensor]]]:
+        """
+        Maps each text to its stored embedding, encoding only cache misses:
+          - "sequence": (padded [max_len, H] states, [max_len] bool mask)
+          - "pooled":   (mask-aware mean [H], None)
+        """
+        seqs = {}
+        for text in texts:
+            seq = self.embedding_cache.get(text) if self.embedding_cache else None
+            if seq is not None:
+                seqs[text] = seq
+        misses = [t for t in texts if t not in seqs]
+        if misses:
+            for text, seq in zip(misses, self._encode_texts(misses)):
+                seqs[text] = seq
+                if self.embedding_cache:
+                    self.embedding_cache.put(text, seq)
+        out = {}
+        for text in texts:
+            seq = seqs[text][:self.text_max_length]
+            self.hidden_size = seq.size(1)
+            if self.text_storage == "pooled":
+                # seq only holds real tokens, so a plain mean is the attention-mask-aware mean
+                out[text] = (seq.sum(dim=0) / max(seq.size(0), 1), None)
+            else:
+                out[text] = pad_text_sequence(seq, self.text_max_length)
+        return out
+
+    def __len__(self): return self.fields['lengths'].size(0)
+
+    def __getitems__(self, indices):
+        """Ready batch (same keys as collate_fn output) for a list of indices, with no per-sample work."""
+        idx = torch.as_tensor(indices, dtype=torch.long)
+        idx = torch.where(idx < 0, idx + len(self), idx)
+        rows = {name: t.index_select(0, idx) for name, t in self.fields.items()}
+        packed = {name: _gather_packed(values, offsets, idx) for name, (values, offsets) in self.packed.items()}
+        return _batch_from_fields(rows, packed, self.text_embs, self.text_mask)
+
     def __getitem__(self, idx):
-        sample = self.samples[idx]
-        p_segs = sample['parent_bezier']
-        # for a single sample, there's no padding, so mask is all False
-        pad_mask = torch.zeros(p_segs.size(0), dtype=torch.bool)
+        return _unbatch(self.__getitems__([idx]))
 
-        return {
-            'child_embs':        sample['child_embs'],
-            'child_mask':        sample['child_mask'],
-            'parent_embs':       sample['parent_embs'],
-            'parent_mask':       sample['parent_mask'],
-            'parent_bbox':       sample['parent_bbox'],
-            'parent_bezier':     sample['parent_bezier'],
-            'parent_bezier_segs':sample['parent_bezier'],   # same as parent_bezier
-            'padding_mask':      pad_mask,
-            'gt_curves':         sample['gt_curves'],
-            'lengths':           sample['lengths'],
+
+def _stack_rows(arrays: List[np.ndarray], shape: Tuple[int, ...]) -> torch.Tensor:
+    """float32 [N, *shape] tensor from N numpy arrays (also for N = 0)."""
+    if not arrays:
+        return torch.zeros((0,) + shape, dtype=torch.float32)
+    return torch.from_numpy(np.stack(arrays)).float()
+
+
+def _pack_rows(arrays: List[np.ndarray]) -> Tuple[torch.Tensor, torch.Tensor]:
+    """N variable-length [K_i, 6] arrays -> float32 values [sum K_i, 6] and long offsets [N+1]."""
+    offsets = torch.zeros(len(arrays) + 1, dtype=torch.long)
+    offsets[1:] = torch.cumsum(torch.tensor([len(a) for a in arrays], dtype=torch.long), 0)
+    if not arrays:
+        return torch.zeros((0, 6), dtype=torch.float32), offsets
+    return torch.from_numpy(np.concatenate(arrays).reshape(-1, 6)).float(), offsets
+
+
+def _packed_owner(offsets: torch.Tensor, total: int) -> torch.Tensor:
+    """[total] index of the sequence each packed row belongs to (offsets [B+1])."""
+    rows = torch.arange(total, device=offsets.device)
+    return torch.searchsorted(offsets[1:], rows, right=True)
+
+
+def _packed_row_ids(starts: torch.Tensor, counts: torch.Tensor,
+                    total: Optional[int] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Row ids into a packed store for sequences given by `starts` / `counts` [B],
+    plus the [B+1] offsets of the gathered batch. Pass `total` (= counts.sum())
+    from the host when counts live on a device, to avoid a sync.
+    """
+    batch_offsets = torch.zeros(counts.numel() + 1, dtype=torch.long, device=counts.device)
+    batch_offsets[1:] = torch.cumsum(counts, 0)
+    if total is None:
+        total = int(batch_offsets[-1])
+    owner = _packed_owner(batch_offsets, total)
+    rows = torch.arange(total, device=counts.device)
+    return starts[owner] + (rows - batch_offsets[owner]), batch_offsets
+
+
+def _gather_packed(values: torch.Tensor, offsets: torch.Tensor, idx: torch.Tensor,
+                   total: Optional[int] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Packed (values, offsets) of sequences `idx` from a packed store."""
+    starts = offsets.index_select(0, idx)
+    ids, batch_offsets = _packed_row_ids(starts, offsets.index_select(0, idx + 1) - starts, total)
+    return values.index_select(0, ids), batch_offsets
+
+
+def _pad_packed(values: torch.Tensor, offsets: torch.Tensor, max_len: int, pad_value: float) -> torch.Tensor:
+    """Packed (values [sum K_b, C], offsets [B+1]) -> [B, max_len, C], max_len >= every K_b."""
+    owner = _packed_owner(offsets, values.size(0))
+    pos = torch.arange(values.size(0), device=values.device) - offsets[owner]
+    out = values.new_full((offsets.numel() - 1, max_len, values.size(1)), pad_value)
+    out[owner, pos] = values
+    return out
+
+
+def _parent_segment_counts(p_segs: torch.Tensor) -> torch.Tensor:
+    """[..., S, 6] -1-padded segments -> [...] number of real (non-padding) rows."""
+    return (~(p_segs == -1).all(dim=-1)).sum(dim=-1)
+
+
+def loss_targets(gt_curves: torch.Tensor, lengths: torch.Tensor) -> Dict[str, torch.Tensor]:
+    """
+    Per-sample loss targets for -1-padded GT curves [B, T, 6] and lengths [B], as compact tensors:
+      gt_types    [B, T] int8  0 = line, 1 = quadratic, 2 = cubic (from which control points are < 0)
+      valid_mask  [B, T] bool  real segments
+      target_stop [B, T] bool  True from the last real segment on
+      stop_weight [B, T] float 5 where target_stop, else 1
+      coord_mask  [B, T, 6] bool  coordinates of real segments the GT actually has (not -1)
+    Pure tensor ops, so they run in the data pipeline on host or device without syncs.
+    """
+    T = gt_curves.size(1)
+    c1_absent = (gt_curves[..., :2] < 0).all(dim=-1)
+    c2_absent = (gt_curves[..., 2:4] < 0).all(dim=-1)
+    gt_types = torch.where(c1_absent, torch.where(c2_absent, 0, 1), 2).to(torch.int8)
+    steps = torch.arange(T, device=gt_curves.device).unsqueeze(0)
+    valid_mask = steps < lengths.unsqueeze(1)
+    target_stop = steps >= (lengths - 1).clamp(min=0).unsqueeze(1)
+    return {
+        'gt_types':    gt_types,
+        'valid_mask':  valid_mask,
+        'target_stop': target_stop,
+        'stop_weight': torch.where(target_stop, 5.0, 1.0),
+        'coord_mask':  valid_mask.unsqueeze(-1) & (gt_curves != -1),
+    }
+
+
+def compute_parent_frame(parent_bezier: torch.Tensor,
+                         parent_offsets: Optional[torch.Tensor] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Bounding box of the parent's Bézier points as (mins, ranges), each (B, 1, 2);
+    predictions are normalized to this frame. Padded (B, S, 6) or packed input.
+    Pure tensor ops, so the data pipeline emits it with each batch (see _batch_from_fields).
+    """
+    if parent_offsets is not None:
+        # Packed parents: per-sample min/max over the real points with scatter_reduce
+        B_p = parent_offsets.numel() - 1
+        pts = parent_bezier.reshape(-1, 2)                                       # (sum S_b * 3, 2)
+        owner = _packed_owner(parent_offsets, parent_bezier.size(0)).repeat_interleave(3)
+        owner = owner.unsqueeze(-1).expand(-1, 2)
+        valid = (pts[:, 0] != -1).unsqueeze(-1)  # Assumes both x and y are -1 together
+        mins = pts.new_full((B_p, 2), float('inf')).scatter_reduce(
+            0, owner, pts.masked_fill(~valid, float('inf')), reduce='amin')
+        maxs = pts.new_full((B_p, 2), float('-inf')).scatter_reduce(
+            0, owner, pts.masked_fill(~valid, float('-inf')), reduce='amax')
+        parent_mins = mins.unsqueeze(1)                                          # (B, 1, 2)
+        parent_ranges = (maxs - mins).unsqueeze(1).clamp(min=1e-6)               # (B, 1, 2)
+    else:
+        # Derive parent_bbox from parent_bezier (assuming parent_bezier coords are absolute)
+        # parent_bezier is (B, max_segments, 6). Reshape to access points.
+        parent_pts_reshaped = parent_bezier.reshape(parent_bezier.size(0), -1, 2) # (B, max_p_seg * 3, 2)
+    
+        mask = parent_pts_reshaped[..., 0] != -1  # Assumes both x and y are -1 together
+
+        # For X coordinates
+        x_vals = parent_pts_reshaped[..., 0]
+        x_masked_min = x_vals.masked_fill(~mask, float('inf'))
+        x_masked_max = x_vals.masked_fill(~mask, float('-inf'))
+        parent_xmin, _ = x_masked_min.min(dim=1, keepdim=True)
+        parent_xmax, _ = x_masked_max.max(dim=1, keepdim=True)
+
+        # For Y coordinates
+        y_vals = parent_pts_reshaped[..., 1]
+        y_masked_min = y_vals.masked_fill(~mask, float('inf'))
+        y_masked_max = y_vals.masked_fill(~mask, float('-inf'))
+        parent_ymin, _ = y_masked_min.min(dim=1, keepdim=True)
+        parent_ymax, _ = y_masked_max.max(dim=1, keepdim=True)
+
+        parent_mins = torch.cat([parent_xmin, parent_ymin], dim=1).unsqueeze(1) # (B, 1, 2)
+        parent_ranges = torch.cat([parent_xmax - parent_xmin, parent_ymax - parent_ymin], dim=1).unsqueeze(1).clamp(min=1e-6) # (B, 1, 2)
+    return parent_mins, parent_ranges
+
+
+# Packed keys of a batch; single items (_unbatch) only carry the padded tensors
+_PACKED_BATCH_KEYS = ('parent_bezier_values', 'parent_bezier_offsets')
+_TARGET_KEYS = ('gt_types', 'valid_mask', 'target_stop', 'stop_weight', 'coord_mask')
+_FRAME_KEYS = ('parent_mins', 'parent_ranges')
+
+
+def _batch_from_fields(rows: Dict[str, torch.Tensor],
+                       packed: Dict[str, Tuple[torch.Tensor, torch.Tensor]],
+                       text_embs, text_mask,
+                       num_queries: Optional[int] = None,
+                       num_parent_segments: Optional[int] = None) -> Dict[str, torch.Tensor]:
+    """
+    Assembles a collated batch from already-gathered per-field rows
+    (parent_bbox, lengths, child_text, parent_text), the batch's packed
+    parent_bezier / gt_curves (values, offsets) and the text table; shared by
+    AugmentedDataset, ShardedSampleDataset and DeviceResidentLoader.
+
+    The batch carries the packed parents as parent_bezier_values/_offsets,
+    -1-padded parent_bezier / gt_curves views as wide as the longest parent /
+    child of the batch, the loss_targets of gt_curves and the parent frame
+    (parent_mins / parent_ranges, see compute_parent_frame). `num_queries` (a host int,
+    also put in the batch) is the child length the decoder needs. Both widths
+    are derived from the offsets unless given, which callers with
+    device-resident rows do to avoid a sync.
+    """
+    p_values, p_offsets = packed['parent_bezier']
+    g_values, g_offsets = packed['gt_curves']
+    if num_queries is None:
+        num_queries = int((g_offsets[1:] - g_offsets[:-1]).max()) if rows['lengths'].numel() else 1
+    if num_parent_segments is None:
+        num_parent_segments = int((p_offsets[1:] - p_offsets[:-1]).max()) if rows['lengths'].numel() else 1
+    num_queries, num_parent_segments = max(1, num_queries), max(1, num_parent_segments)
+    p_segs = _pad_packed(p_values, p_offsets, num_parent_segments, -1.0)
+    batch = {
+        'child_embs':        text_embs.index_select(0, rows['child_text']),
+        'parent_embs':       text_embs.index_select(0, rows['parent_text']),
+        'parent_bbox':       rows['parent_bbox'],
+        'parent_bezier':     p_segs,
+        'parent_bezier_segs':p_segs,   # same tensor
+        'padding_mask':      (p_segs == -1).all(dim=-1),  # lines/quadratics have -1 control slots too
+        'gt_curves':         _pad_packed(g_values, g_offsets, num_queries, -1.0),
+        'lengths':           rows['lengths'],
+        'num_queries':       num_queries,
+        'parent_bezier_values':  p_values,
+        'parent_bezier_offsets': p_offsets,
+    }
+    batch.update(loss_targets(batch['gt_curves'], batch['lengths']))
+    batch['parent_mins'], batch['parent_ranges'] = compute_parent_frame(p_values, p_offsets)
+    if text_mask is not None:  # sequence storage only
+        batch['child_mask'] = text_mask.index_select(0, rows['child_text'])
+        batch['parent_mask'] = text_mask.index_select(0, rows['parent_text'])
+    return batch
+
+
+def _unbatch(batch: Dict[str, torch.Tensor]) -> Dict:
+    """Single item from a batch of one: row 0 of every field, lengths as an int."""
+    skip = _PACKED_BATCH_KEYS + _TARGET_KEYS + _FRAME_KEYS
+    item = {k: v[0] for k, v in batch.items() if torch.is_tensor(v) and k not in skip}
+    item['lengths'] = int(item['lengths'])
+    return item
+
+
+# -----------------------------------------------------------------------------
+# Sharded, memory-mapped sample store
+# -----------------------------------------------------------------------------
+# Layout of a shard directory:
+#   index.json               num_samples, shard starts/counts, field dtypes/shapes, text settings
+#   text_embs.npy            [U, 512, H] (sequence) or [U, H] (pooled), one row per unique description
+#   text_mask.npy            [U, 512] bool, sequence storage only
+#   <field>.<shard>.npy      per-sample fields, fixed layout, shard_size rows per shard:
+#                            child_text/parent_text (int32 rows into the text table),
+#                            parent_bbox [4,2], lengths (int64)
+#   <seq>.values.<shard>.npy packed parent_bezier / gt_curves rows [sum K, 6] of the shard,
+#   <seq>.offsets.<shard>.npy  with shard-local [count+1] int64 offsets
+# index.json is written last, so a directory without it is an unfinished preprocess run.
+SHARD_FORMAT_VERSION = 2
+_SHARD_FIELDS = ('child_text', 'parent_text', 'parent_bbox', 'lengths')
+_SHARD_PACKED = ('parent_bezier', 'gt_curves')
+
+
+def write_sample_shards(ds: AugmentedDataset, out_dir: str, shard_size: int = 4096) -> str:
+    """Writes a built AugmentedDataset to `out_dir` as memory-mappable shards; returns the index path."""
+    if len(ds) == 0:
+        raise ValueError(f"Refusing to write an empty dataset to {out_dir}")
+    os.makedirs(out_dir, exist_ok=True)
+    # Drop any previous index first: a run that dies while rewriting the shards
+    # must leave an unfinished directory, not an old index over new shards
+    index_path = os.path.join(out_dir, "index.json")
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    index = {
+        'version': SHARD_FORMAT_VERSION,
+        'num_samples': len(ds),
+        'text_storage': ds.text_storage,
+        'text_max_length': ds.text_max_length,
+        'hidden_size': ds.hidden_size,
+        'shards': [],
+        'fields': {},
+    }
+    np.save(os.path.join(out_dir, "text_embs.npy"), ds.text_embs.numpy())
+    if ds.text_mask is not None:
+        np.save(os.path.join(out_dir, "text_mask.npy"), ds.text_mask.numpy())
+
+    n = len(ds)
+    for shard, start in enumerate(range(0, n, shard_size)):
+        stop = min(start + shard_size, n)
+        arrays = {
+            'child_text':    ds.fields['child_text'][start:stop].numpy().astype(np.int32),
+            'parent_text':   ds.fields['parent_text'][start:stop].numpy().astype(np.int32),
+            'parent_bbox':   ds.fields['parent_bbox'][start:stop].numpy(),
+            'lengths':       ds.fields['lengths'][start:stop].numpy(),
+        }
+        for name in _SHARD_PACKED:
+            values, offsets = ds.packed[name]
+            lo, hi = int(offsets[start]), int(offsets[stop])
+            arrays[f"{name}.values"] = values[lo:hi].numpy()
+            arrays[f"{name}.offsets"] = (offsets[start:stop + 1] - lo).numpy()
+        for name, arr in arrays.items():
+            np.save(os.path.join(out_dir, f"{name}.{shard:05d}.npy"), arr)
+            index['fields'][name] = {'dtype': str(arr.dtype), 'shape': list(arr.shape[1:])}
+        index['shards'].append({'start': start, 'count': stop - start})
+
+    with open(index_path + ".tmp", "w") as f:
+        json.dump(index, f, indent=2)
+    os.replace(index_path + ".tmp", index_path)
+    return index_path
+
+
+class ShardedSampleDataset(Dataset):
+    """
+    Read-only dataset over a write_sample_shards directory. Every array is opened
+    with mmap_mode='r', so start-up only reads index.json and processes training
+    on the same store share the OS page cache instead of private copies.
+    Items have the same keys and shapes as AugmentedDataset items.
+    """
+    def __init__(self, shard_dir: str):
+        super().__init__()
+        with open(os.path.join(shard_dir, "index.json")) as f:
+            index = json.load(f)
+        if index.get('version') != SHARD_FORMAT_VERSION:
+            raise ValueError(f"Unsupported shard format {index.get('version')!r} in {shard_dir}")
+        self.shard_dir = shard_dir
+        self.text_storage = index['text_storage']
+        self.text_max_length = index['text_max_length']
+        self.hidden_size = index['hidden_size']
+        self.num_samples = index['num_samples']
+        self.shard_starts = [sh['start'] for sh in index['shards']]
+        self.text_embs = np.load(os.path.join(shard_dir, "text_embs.npy"), mmap_mode='r')
+        self.text_mask = (
+            np.load(os.path.join(shard_dir, "text_mask.npy"), mmap_mode='r')
+            if self.text_storage == "sequence" else None
+        )
+        names = _SHARD_FIELDS + tuple(f"{seq}.{part}" for seq in _SHARD_PACKED for part in ("values", "offsets"))
+        self.shards = [
+            {name: np.load(os.path.join(shard_dir, f"{name}.{i:05d}.npy"), mmap_mode='r') for name in names}
+            for i in range(len(index['shards']))
+        ]
+
+    def __len__(self): return self.num_samples
+
+    def __getitems__(self, indices):
+        """Ready batch for a list of indices: one fancy-index read per (shard, field)."""
+        idx = np.asarray(indices, dtype=np.int64)
+        if idx.size and (idx.min() < -self.num_samples or idx.max() >= self.num_samples):
+            raise IndexError(indices)
+        idx = np.where(idx < 0, idx + self.num_samples, idx)
+        shard_of = np.searchsorted(self.shard_starts, idx, side='right') - 1
+        rows = {}
+        for name in _SHARD_FIELDS:
+            field = self.shards[0][name]
+            out = np.empty((idx.size,) + field.shape[1:], field.dtype)  # also right for an empty index list
+            for shard in np.unique(shard_of):
+                sel = np.flatnonzero(shard_of == shard)
+                out[sel] = self.shards[shard][name][idx[sel] - self.shard_starts[shard]]  # copies out of the map
+            rows[name] = torch.from_numpy(out)
+        packed = {}
+        for name in _SHARD_PACKED:
+            # read each shard's sequences, then lay them out in batch order
+            starts = torch.zeros(idx.size, dtype=torch.long)
+            counts = torch.zeros(idx.size, dtype=torch.long)
+            blocks, base = [], 0
+            for shard in np.unique(shard_of):
+                sel = torch.from_numpy(np.flatnonzero(shard_of == shard))
+                local = idx[sel.numpy()] - self.shard_starts[shard]
+                offsets = self.shards[shard][f"{name}.offsets"]
+                lo, hi = torch.from_numpy(offsets[local]), torch.from_numpy(offsets[local + 1])
+                ids, block_offsets = _packed_row_ids(lo, hi - lo)
+                blocks.append(torch.from_numpy(self.shards[shard][f"{name}.values"][ids.numpy()]))
+                starts[sel] = base + block_offsets[:-1]
+                counts[sel] = block_offsets[1:] - block_offsets[:-1]
+                base += int(block_offsets[-1])
+            block = torch.cat(blocks) if blocks else torch.zeros((0, 6), dtype=torch.float32)
+            ids, batch_offsets = _packed_row_ids(starts, counts)
+            packed[name] = (block.index_select(0, ids), batch_offsets)
+        rows['child_text'] = rows['child_text'].long()
+        rows['parent_text'] = rows['parent_text'].long()
+        # only the text rows this batch needs are read from the table
+        used, inverse = np.unique(torch.cat([rows['child_text'], rows['parent_text']]).numpy(), return_inverse=True)
+        inverse = torch.from_numpy(inverse.reshape(-1)).long()
+        rows['child_text'], rows['parent_text'] = inverse[:idx.size], inverse[idx.size:]
+        text_embs = torch.from_numpy(self.text_embs[used])
+        text_mask = torch.from_numpy(self.text_mask[used]) if self.text_mask is not None else None
+        return _batch_from_fields(rows, packed, text_embs, text_mask)
+
+    def __getitem__(self, idx):
+        return _unbatch(self.__getitems__([idx]))
+
+    def read_all(self):
+        """
+        Every shard and the text table read into memory, like AugmentedDataset:
+        (fields, packed, text_embs, text_mask).
+        """
+        fields = {
+            name: torch.from_numpy(np.concatenate([shard[name] for shard in self.shards]))
+            for name in _SHARD_FIELDS
         }
+        fields['child_text'] = fields['child_text'].long()
+        fields['parent_text'] = fields['parent_text'].long()
+        packed = {}
+        for name in _SHARD_PACKED:
+            values = [np.asarray(shard[f"{name}.values"]) for shard in self.shards]
+            offsets, base = [np.zeros(1, np.int64)], 0
+            for shard, vals in zip(self.shards, values):
+                offsets.append(np.asarray(shard[f"{name}.offsets"])[1:] + base)
+                base += len(vals)
+            packed[name] = (
+                torch.from_numpy(np.concatenate(values).reshape(-1, 6)),
+                torch.from_numpy(np.concatenate(offsets)),
+            )
+        text_mask = torch.from_numpy(np.array(self.text_mask)) if self.text_mask is not None else None
+        return fields, packed, torch.from_numpy(np.array(self.text_embs)), text_mask
+
+
+def preprocess_to_shards(dataset_path: str, shard_dir: str, shard_size: int = 4096, **dataset_kwargs) -> str:
+    """Builds an AugmentedDataset once and writes it to `shard_dir` (see write_sample_shards)."""
+    ds = AugmentedDataset(root_dir=dataset_path, **dataset_kwargs)
+    unload_t5_encoder()
+    index_path = write_sample_shards(ds, shard_dir, shard_size=shard_size)
+    print(f"Wrote {len(ds)} samples to {shard_dir}")
+    return index_path
 
 
 # -----------------------------------------------------------------------------
 # collate_fn
 # -----------------------------------------------------------------------------
 def collate_fn(batch):
+    if isinstance(batch, dict):  # already collated by a dataset's __getitems__
+        return batch
+    # [B, 512, H] sequences or [B, H] pooled vectors, depending on the dataset's text_storage
     child_embs    = torch.stack([b['child_embs']    for b in batch], dim=0)
-    child_mask    = torch.stack([b['child_mask']    for b in batch], dim=0)
     parent_embs   = torch.stack([b['parent_embs']   for b in batch], dim=0)
-    parent_mask   = torch.stack([b['parent_mask']   for b in batch], dim=0)
     bbox          = torch.stack([b['parent_bbox']   for b in batch], dim=0)
 
     # pad parent_bezier (and use same for parent_bezier_segs)
     pb              = [b['parent_bezier'] for b in batch]
     parent_bezier   = torch.nn.utils.rnn.pad_sequence(pb, batch_first=True, padding_value=-1.0)
-    padding_mask    = parent_bezier[:,:,0] < 0
+    padding_mask    = (parent_bezier == -1).all(dim=-1)
 
-    # pad gt_curves
+    # pad gt_curves, trimmed to the longest child of the batch
     gc           = [b['gt_curves'] for b in batch]
-    gt_curves    = torch.nn.utils.rnn.pad_sequence(gc, batch_first=True, padding_value=0.0)
-
     lengths      = torch.tensor([b['lengths'] for b in batch], dtype=torch.long)
+    num_queries  = max(1, int(lengths.max())) if lengths.numel() else 1
+    gt_curves    = torch.nn.utils.rnn.pad_sequence(gc, batch_first=True, padding_value=-1.0)[:, :num_queries]
 
-    return {
+    # packed (values, offsets) of the real rows, the layout the shape encoder consumes
+    p_rows = [p[:int(_parent_segment_counts(p))] for p in pb]
+    p_offsets = torch.zeros(len(batch) + 1, dtype=torch.long)
+    p_offsets[1:] = torch.cumsum(torch.tensor([len(p) for p in p_rows], dtype=torch.long), 0)
+
+    out = {
         'child_embs':        child_embs,
-        'child_mask':        child_mask,
         'parent_embs':       parent_embs,
-        'parent_mask':       parent_mask,
         'parent_bbox':       bbox,
         'parent_bezier':     parent_bezier,
         'parent_bezier_segs':parent_bezier,   # same padded tensor
         'padding_mask':      padding_mask,
         'gt_curves':         gt_curves,
         'lengths':           lengths,
+        'num_queries':       num_queries,
+        'parent_bezier_values':  torch.cat(p_rows).reshape(-1, 6),
+        'parent_bezier_offsets': p_offsets,
     }
+    out.update(loss_targets(gt_curves, lengths))
+    out['parent_mins'], out['parent_ranges'] = compute_parent_frame(out['parent_bezier_values'], p_offsets)
+    if 'child_mask' in batch[0]:
+        out['child_mask']  = torch.stack([b['child_mask']  for b in batch], dim=0)
+        out['parent_mask'] = torch.stack([b['parent_mask'] for b in batch], dim=0)
+    return out
+
+
+# -----------------------------------------------------------------------------
+# Device-resident batching
+# -----------------------------------------------------------------------------
+def _dataset_tables(ds):
+    """
+    (per-sample fields, packed sequences, text_embs, text_mask) of an
+    AugmentedDataset, ShardedSampleDataset or a Subset of one.
+    """
+    if isinstance(ds, Subset):
+        fields, packed, text_embs, text_mask = _dataset_tables(ds.dataset)
+        idx = torch.as_tensor(list(ds.indices), dtype=torch.long)
+        fields = {k: v.index_select(0, idx) for k, v in fields.items()}
+        packed = {k: _gather_packed(values, offsets, idx) for k, (values, offsets) in packed.items()}
+        return fields, packed, text_embs, text_mask
+    if isinstance(ds, ShardedSampleDataset):
+        return ds.read_all()
+    return ds.fields, ds.packed, ds.text_embs, ds.text_mask
+
+
+def _dataset_lengths(ds) -> torch.Tensor:
+    """[N] child segment counts of an AugmentedDataset, ShardedSampleDataset or a Subset of one (host, cheap)."""
+    if isinstance(ds, Subset):
+        return _dataset_lengths(ds.dataset)[torch.as_tensor(list(ds.indices), dtype=torch.long)]
+    if isinstance(ds, ShardedSampleDataset):
+        return torch.from_numpy(np.concatenate([shard['lengths'] for shard in ds.shards])).long()
+    return ds.fields['lengths']
+
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Batch sampler that groups samples by child segment count (buckets of
+    `bucket_width` consecutive counts), so that batches trimmed to their longest
+    shape (see _batch_from_fields) run few decoder queries. Shuffles within
+    buckets and the batch order every epoch when `shuffle`.
+    """
+    def __init__(self, lengths, batch_size: int, bucket_width: int = 1,
+                 shuffle: bool = True, drop_last: bool = False):
+        self.lengths = torch.as_tensor(lengths, dtype=torch.long)
+        self.batch_size = batch_size
+        self.bucket_width = max(1, bucket_width)
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        keys = self.lengths // self.bucket_width
+        self.buckets = [torch.nonzero(keys == k).flatten() for k in torch.unique(keys)]
+
+    def __len__(self):
+        if self.drop_last:
+            return sum(len(b) // self.batch_size for b in self.buckets)
+        return sum((len(b) + self.batch_size - 1) // self.batch_size for b in self.buckets)
+
+    def __iter__(self):
+        batches = []
+        for bucket in self.buckets:
+            if self.shuffle:
+                bucket = bucket[torch.randperm(len(bucket))]
+            for start in range(0, len(bucket), self.batch_size):
+                chunk = bucket[start:start + self.batch_size]
+                if self.drop_last and len(chunk) < self.batch_size:
+                    continue
+                batches.append(chunk.tolist())
+        order = torch.randperm(len(batches)).tolist() if self.shuffle else range(len(batches))
+        for i in order:
+            yield batches[i]
+
+
+class DeviceResidentLoader:
+    """
+    DataLoader replacement that uploads all per-sample fields and the text table
+    to `device` once; each epoch draws an on-device randperm and every batch is
+    one index_select per field, so steps do no host->device copies.
+    Yields the same dicts as collate_fn.
+
+    Batch trimming needs the longest child/parent per batch on the host: segment
+    counts are kept on the host too and the permutation is copied back once per
+    epoch. With a `batch_sampler` (e.g. LengthBucketBatchSampler) its index
+    lists are used instead, uploaded per batch.
+    """
+    def __init__(self, ds, batch_size: int, device, shuffle: bool = True,
+                 batch_sampler: Optional[Sampler] = None):
+        fields, packed, text_embs, text_mask = _dataset_tables(ds)
+        # host copies of the per-sample sequence lengths (trim widths and packed totals)
+        self.counts = {k: (offsets[1:] - offsets[:-1]).cpu() for k, (_, offsets) in packed.items()}
+        self.fields = {k: v.to(device) for k, v in fields.items()}
+        self.packed = {k: (values.to(device), offsets.to(device)) for k, (values, offsets) in packed.items()}
+        self.text_embs = text_embs.to(device)
+        self.text_mask = text_mask.to(device) if text_mask is not None else None
+        self.num_samples = self.fields['lengths'].size(0)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.batch_sampler = batch_sampler
+        self.device = device
+
+    def __len__(self):
+        if self.batch_sampler is not None:
+            return len(self.batch_sampler)
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
+
+    def _batch(self, idx: torch.Tensor, idx_host: torch.Tensor):
+        rows = {k: v.index_select(0, idx) for k, v in self.fields.items()}
+        packed = {
+            k: _gather_packed(values, offsets, idx, total=int(self.counts[k][idx_host].sum()))
+            for k, (values, offsets) in self.packed.items()
+        }
+        return _batch_from_fields(
+            rows, packed, self.text_embs, self.text_mask,
+            num_queries=int(self.counts['gt_curves'][idx_host].max()),
+            num_parent_segments=int(self.counts['parent_bezier'][idx_host].max()),
+        )
+
+    def __iter__(self):
+        if self.batch_sampler is not None:
+            for indices in self.batch_sampler:
+                idx_host = torch.as_tensor(indices, dtype=torch.long)
+                yield self._batch(idx_host.to(self.device, non_blocking=True), idx_host)
+            return
+        if self.shuffle:
+            order = torch.randperm(self.num_samples, device=self.device)
+        else:
+            order = torch.arange(self.num_samples, device=self.device)
+        order_host = order.cpu()  # one copy per epoch, for the per-batch trim lengths
+        for start in range(0, self.num_samples, self.batch_size):
+            yield self._batch(order[start:start + self.batch_size], order_host[start:start + self.batch_size])
 
 from transformers import T5Tokenizer, T5EncoderModel
-from dataclasses import dataclass
+import dataclasses
+from dataclasses import dataclass, asdict
 
 @dataclass
 class PolygonConfig:
@@ -586,6 +2038,15 @@ class PolygonConfig:
     num_fusion_layers: int = 2
     t5_model_name: str = "google/flan-t5-base"
     max_text_length: int = 512
+    # False builds a headless model that only consumes precomputed embeddings
+    # (never loads T5); text_proj is then sized from text_hidden_size.
+    load_text_encoder: bool = True
+    text_hidden_size: int = 768
+    # True: decoder queries attend causally and stop score t reads only step t, so
+    # decoding the first T queries gives the same outputs as decoding all of them
+    # (required for length-bucketed training). False: the original bidirectional
+    # decoder with a stop score averaged over all steps.
+    causal_decoder: bool = False
 
 class PositionalEncoding(nn.Module):
     def __init__(self, d_model, dropout=0.1, max_len=30):
@@ -607,6 +2068,60 @@ def generate_square_subsequent_mask(sz: int) -> torch.Tensor:
     mask = torch.triu(torch.ones(sz, sz, dtype=torch.bool), diagonal=1)
     return mask.float().masked_fill(mask, float('-inf')).masked_fill(~mask, 0.0)
 
+class JsonlSink:
+    """Appends each row (a flat dict) as one JSON line to `path`."""
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def __call__(self, row: Dict) -> None:
+        with open(self.path, "a") as f:
+            f.write(json.dumps(row) + "\n")
+
+
+class ActivationStats:
+    """
+    Opt-in recorder for activation mean/std.
+
+    record() only queues device-side reductions into running sums; nothing is
+    read back until flush(), which happens every `flush_every` calls to step()
+    with a single device->host copy, and emits one row to `sink` (print by default).
+    """
+    def __init__(self, flush_every: int = 100, sink=None):
+        self.flush_every = max(int(flush_every), 1)
+        self.sink = sink if sink is not None else print
+        self._sums: Dict[str, torch.Tensor] = {}   # name -> [sum, sum of squares] on device
+        self._counts: Dict[str, int] = {}          # element counts are known on the host
+        self._steps = 0
+
+    def record(self, name: str, x: torch.Tensor) -> None:
+        x = x.detach().float()
+        s = torch.stack([x.sum(), (x * x).sum()])
+        self._sums[name] = s if name not in self._sums else self._sums[name] + s
+        self._counts[name] = self._counts.get(name, 0) + x.numel()
+
+    def step(self) -> None:
+        self._steps += 1
+        if self._steps % self.flush_every == 0:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._sums:
+            return
+        names = list(self._sums)
+        sums = torch.stack([self._sums[n] for n in names]).cpu().tolist()  # the only sync
+        row = {"step": self._steps}
+        for name, (total, total_sq) in zip(names, sums):
+            n = self._counts[name]
+            mean = total / n
+            var = max(total_sq / n - mean * mean, 0.0) * n / max(n - 1, 1)  # unbiased, like Tensor.std()
+            row[f"{name}/mean"] = mean
+            row[f"{name}/std"] = math.sqrt(var)
+        self.sink(row)
+        self._sums.clear()
+        self._counts.clear()
+
+
 class ShapePredictor(nn.Module):
     def __init__(self,
                  d_model: int,
@@ -615,10 +2130,13 @@ class ShapePredictor(nn.Module):
                  num_segments: int,
                  dim_feedforward: int,
                  dropout: float,
-                 out_dim: int = 6):
+                 out_dim: int = 6,
+                 causal: bool = False):
         super().__init__()
         self.num_segments = num_segments
+        self.causal = causal
         self.d_model = d_model
+        self.activation_stats: Optional["ActivationStats"] = None  # attach to collect scale stats
 
         # Revert query_embed to standard initialization (important for PE)
         self.query_embed = nn.Parameter(torch.randn(num_segments, d_model))
@@ -655,25 +2173,32 @@ class ShapePredictor(nn.Module):
 
 
 
-    def forward(self, H_memory: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    def forward(self, H_memory: torch.Tensor, num_queries: Optional[int] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        # num_queries < num_segments runs only the first queries (batches of short shapes).
+        # That needs causal attention (step t sees steps <= t), so the first T steps come
+        # out the same whether T or all num_segments queries are decoded.
         B = H_memory.size(0)
-        content_queries = self.query_embed.unsqueeze(0).expand(B, -1, -1)
+        if num_queries is not None and num_queries > self.num_segments:
+            raise ValueError(f"num_queries={num_queries} exceeds the decoder's {self.num_segments} queries")
+        if num_queries is not None and num_queries < self.num_segments and not self.causal:
+            raise ValueError("Decoding fewer queries than num_segments requires a causal decoder (PolygonConfig.causal_decoder)")
+        queries = self.query_embed if num_queries is None else self.query_embed[:num_queries]
+        T = queries.size(0)
+        content_queries = queries.unsqueeze(0).expand(B, -1, -1)
         tgt = self.positional_encoder(content_queries)
-        print("tgt mean:", tgt.mean().item(), "std:", tgt.std().item())  # Debugging line
-        decoded_hidden_states = self.decoder(tgt=tgt, memory=H_memory)
-        print("decoded_hidden_states mean:", decoded_hidden_states.mean().item(), "std:", decoded_hidden_states.std().item())  # Debugging line
-        # DEBUG: Check scale
-        # print(f"decoded_hidden_states mean: {decoded_hidden_states.mean().item():.4f}, std: {decoded_hidden_states.std().item():.4f}")
-        # L1_output = self.output_head[0](decoded_hidden_states)
-        # print(f"L1_output (before Square) mean: {L1_output.mean().item():.4f}, std: {L1_output.std().item():.4f}")
-        # Square_output = self.output_head[1](L1_output)
-        # print(f"Square_output mean: {Square_output.mean().item():.4f}, std: {Square_output.std().item():.4f}")
-
+        if self.causal:
+            causal_mask = torch.ones(T, T, dtype=torch.bool, device=tgt.device).triu(1)  # True = not attended
+            decoded_hidden_states = self.decoder(tgt=tgt, memory=H_memory, tgt_mask=causal_mask, tgt_is_causal=True)
+        else:
+            decoded_hidden_states = self.decoder(tgt=tgt, memory=H_memory)
         coords = self.output_head(decoded_hidden_states)
-        # Your existing print for final coords before sigmoid:
-        end_coords = coords[..., 5:6]
-        print("coords mean:", end_coords.mean().item(), "std:", end_coords.std().item()) 
-        
+
+        # Opt-in scale debugging; with no recorder attached this path has no sync points
+        if self.activation_stats is not None:
+            self.activation_stats.record("tgt", tgt)
+            self.activation_stats.record("decoded_hidden_states", decoded_hidden_states)
+            self.activation_stats.record("end_coords", coords[..., 5:6])
+
         return coords, decoded_hidden_states
 
 class SimpleShapeEncoder(nn.Module): # Parent Shape Encoder
@@ -695,20 +2220,17 @@ class SimpleShapeEncoder(nn.Module): # Parent Shape Encoder
 
         if C_in != self.input_proj.in_features:
             raise ValueError(f"SimpleShapeEncoder expects {self.input_proj.in_features} features, got {C_in}")
-        if S_parent_actual > self.seq_len:
-            shape_pts = shape_pts[:, :self.seq_len, :]
-            S_parent_actual = self.seq_len
 
+        # Nothing is truncated: segments past seq_len reuse the last position embedding (as forward_packed)
+        pos = torch.arange(S_parent_actual, device=shape_pts.device).clamp(max=self.seq_len - 1)
         x = self.input_proj(shape_pts)
-        x = x + self.pos_emb[:S_parent_actual, :].unsqueeze(0)
+        x = x + self.pos_emb[pos].unsqueeze(0)
 
         # Derive valid_segment_mask (True for valid segments) based on -1 fill convention
         is_padding_segment = (shape_pts == -1).all(dim=2) # (B, S_parent_actual)
-        actual_lengths = torch.full((B,), S_parent_actual, dtype=torch.long, device=shape_pts.device)
-        for i in range(B):
-            first_pad_idx = torch.where(is_padding_segment[i])[0]
-            if len(first_pad_idx) > 0:
-                actual_lengths[i] = first_pad_idx[0]
+        # Index of the first padding segment (S_parent_actual if none), without a per-row loop:
+        # the cumulative product of "not padding" stays 1 exactly until the first padding segment.
+        actual_lengths = (~is_padding_segment).long().cumprod(dim=1).sum(dim=1) # (B,)
         
         s_indices = torch.arange(S_parent_actual, device=x.device).expand(B, S_parent_actual)
         # valid_segment_mask: (B, S_parent_actual), True for valid segments
@@ -728,26 +2250,49 @@ class SimpleShapeEncoder(nn.Module): # Parent Shape Encoder
             
         return self.to_latent(x_pooled)
 
+    def forward_packed(self, values: torch.Tensor, offsets: torch.Tensor) -> torch.Tensor:
+        """
+        Packed input: values [sum S_b, in_dim] holding only real segments, offsets [B+1].
+        Nothing is truncated: segments past seq_len reuse the last position embedding.
+        Same masked-mean pooling as forward(), without padding work.
+        """
+        if values.size(-1) != self.input_proj.in_features:
+            raise ValueError(f"SimpleShapeEncoder expects {self.input_proj.in_features} features, got {values.size(-1)}")
+        B = offsets.numel() - 1
+        owner = _packed_owner(offsets, values.size(0))                      # (sum S_b,)
+        pos = torch.arange(values.size(0), device=values.device) - offsets[owner]
+        pos = pos.clamp(max=self.seq_len - 1)
+
+        x = self.input_proj(values) + self.pos_emb[pos]
+        x = self.mlp(x)
+
+        summed_features = x.new_zeros(B, x.size(-1)).index_add_(0, owner, x)
+        num_active_elements = (offsets[1:] - offsets[:-1]).to(x.dtype).unsqueeze(-1).clamp(min=1.0)
+        return self.to_latent(summed_features / num_active_elements)
+
 
 class PolygonPredictor(nn.Module):
     def __init__(self, cfg: PolygonConfig):
         super().__init__()
-        self.cfg = cfg
 
-        try:
-            from transformers import AutoTokenizer, T5EncoderModel
-            self.tokenizer = AutoTokenizer.from_pretrained(cfg.t5_model_name)
-            full_t5_model = T5EncoderModel.from_pretrained(cfg.t5_model_name)
-            self.encoder = full_t5_model.encoder
-            d_text = full_t5_model.config.hidden_size
-            for p in self.encoder.parameters():
-                p.requires_grad = False
-        except ImportError:
-            print(f"Warning: transformers library not found. Mocking T5 components.")
-            self.tokenizer = None; self.encoder = nn.Identity(); d_text = 768
-        except Exception as e:
-            print(f"Error loading T5 model '{cfg.t5_model_name}': {e}. Mocking T5 components.")
-            self.tokenizer = None; self.encoder = nn.Identity(); d_text = 768
+        if not cfg.load_text_encoder:
+            # Headless: forward() only sees precomputed embeddings, so skip T5 entirely
+            self.tokenizer = None; self.encoder = None; d_text = cfg.text_hidden_size
+        else:
+            try:
+                # Shared with AugmentedDataset through the registry (already frozen)
+                self.tokenizer, self.encoder = get_t5_encoder(cfg.t5_model_name)
+                d_text = self.encoder.config.hidden_size
+            except ImportError:
+                print(f"Warning: transformers library not found. Mocking T5 components.")
+                self.tokenizer = None; self.encoder = nn.Identity(); d_text = cfg.text_hidden_size
+            except Exception as e:
+                print(f"Error loading T5 model '{cfg.t5_model_name}': {e}. Mocking T5 components.")
+                self.tokenizer = None; self.encoder = nn.Identity(); d_text = cfg.text_hidden_size
+        # Own copy with the actual text width (stored in checkpoints so they can be rebuilt
+        # headless); the caller's config is left untouched
+        cfg = dataclasses.replace(cfg, text_hidden_size=d_text)
+        self.cfg = cfg
 
         self.text_proj = nn.Linear(d_text, cfg.d_model)
 
@@ -779,7 +2324,8 @@ class PolygonPredictor(nn.Module):
             num_segments=cfg.max_segments, # CRITICAL: Aligned with child output
             dim_feedforward=cfg.dim_feedforward,
             dropout=cfg.dropout,
-            out_dim=6
+            out_dim=6,
+            causal=cfg.causal_decoder,
         )
         self.type_head = nn.Linear(cfg.d_model, 3)
         self.stop_head = nn.Sequential(
@@ -788,19 +2334,33 @@ class PolygonPredictor(nn.Module):
         )
 
 
-    def encode_text_embeddings(self, text_embeddings: torch.Tensor) -> torch.Tensor:
+    def train(self, mode: bool = True):
+        super().train(mode)
+        if self.encoder is not None:
+            self.encoder.eval()  # frozen and possibly shared with a dataset: never enable its dropout
+        return self
+
+    def encode_text_embeddings(self, text_embeddings: torch.Tensor,
+                               attention_mask: Optional[torch.Tensor] = None) -> torch.Tensor:
         # Processes (B, S_text, D_t5) or (B, D_t5) into (B, cfg.d_model)
         if text_embeddings.dim() == 3:
-            # This simple mean pooling assumes no padding or that padding tokens are zero
-            # For more robust pooling with padding, an attention mask from tokenizer output would be needed here.
-            pooled_embs = text_embeddings.mean(dim=1)
+            if attention_mask is not None:
+                # Attention-mask-aware mean, matches AugmentedDataset(text_storage="pooled")
+                m = attention_mask.to(text_embeddings.dtype).unsqueeze(-1)   # (B, S_text, 1)
+                pooled_embs = (text_embeddings * m).sum(dim=1) / m.sum(dim=1).clamp(min=1.0)
+            else:
+                # This simple mean pooling assumes no padding or that padding tokens are zero
+                pooled_embs = text_embeddings.mean(dim=1)
         elif text_embeddings.dim() == 2:
             pooled_embs = text_embeddings
         else:
             raise ValueError(f"Unexpected text_embeddings dim: {text_embeddings.shape}")
         return self.text_proj(pooled_embs)
 
-    def encode_parent_shape(self, parent_bezier_data: torch.Tensor) -> torch.Tensor:
+    def encode_parent_shape(self, parent_bezier_data: torch.Tensor,
+                            parent_offsets: Optional[torch.Tensor] = None) -> torch.Tensor:
+        if parent_offsets is not None:
+            return self.shape_encoder.forward_packed(parent_bezier_data, parent_offsets)
         return self.shape_encoder(parent_bezier_data)
 
     def fuse_modalities(self, c_feat, p_feat, s_feat) -> torch.Tensor: # b_feat removed
@@ -812,104 +2372,110 @@ class PolygonPredictor(nn.Module):
         fused_memory = self.fusion_enc(mods) # (B, 3, cfg.d_model)
         return fused_memory
 
-    def decode_outputs_from_memory(self, fused_mem: torch.Tensor) -> Dict[str, torch.Tensor]:
-        coords_normalized, decoded_hidden_states = self.coord_decoder(fused_mem)
+    def decode_outputs_from_memory(self, fused_mem: torch.Tensor,
+                                   num_queries: Optional[int] = None) -> Dict[str, torch.Tensor]:
+        coords_normalized, decoded_hidden_states = self.coord_decoder(fused_mem, num_queries)
         types_logits = self.type_head(decoded_hidden_states)
-        stop_logits_per_step = self.stop_head(decoded_hidden_states)
-        stop_scores = stop_logits_per_step.mean(dim=1)
-        stop_index = stop_scores.argmax(dim=1)
+        stop_per_step = self.stop_head(decoded_hidden_states)  # (B, T, max_segments)
+        if self.cfg.causal_decoder:
+            # Stop score of step t reads only step t's hidden state (output t of the
+            # head at step t), independent of how many steps were decoded
+            T = decoded_hidden_states.size(1)
+            stop_scores = torch.diagonal(stop_per_step[..., :T], dim1=1, dim2=2)  # (B, T)
+        else:
+            stop_scores = stop_per_step.mean(dim=1)  # (B, max_segments)
 
         return {
             "coords_normalized": coords_normalized,
             "types_logits": types_logits,
-            "stop_index": stop_index,
-            "stop_scores": stop_scores,  # Optional, if needed for further analysis
+            "stop_scores": stop_scores,
         }
 
-    def forward(self,
-                child_embs: torch.Tensor,    # (B, S_text, D_t5) or (B, D_t5)
-                parent_embs: torch.Tensor,   # (B, S_text, D_t5) or (B, D_t5)
-                parent_bezier: torch.Tensor, # (B, cfg.max_segments, 6)
-               ) -> Dict[str, torch.Tensor]:
-
+    def parent_frame(self, parent_bezier: torch.Tensor,
+                     parent_offsets: Optional[torch.Tensor] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """(mins, ranges) of the parent's Bézier points; see compute_parent_frame."""
+        return compute_parent_frame(parent_bezier, parent_offsets)
+
+    def forward_train(self,
+                      child_embs: torch.Tensor,    # (B, S_text, D_t5) or (B, D_t5)
+                      parent_embs: torch.Tensor,   # (B, S_text, D_t5) or (B, D_t5)
+                      parent_bezier: torch.Tensor, # (B, S, 6) -1-padded, or packed (sum S_b, 6) with parent_offsets
+                      child_mask: Optional[torch.Tensor] = None,   # (B, S_text) bool, sequence inputs only
+                      parent_mask: Optional[torch.Tensor] = None,  # (B, S_text) bool, sequence inputs only
+                      num_queries: Optional[int] = None,           # decoder queries T <= cfg.max_segments (None = all)
+                      parent_offsets: Optional[torch.Tensor] = None,  # (B+1,) packed parent_bezier offsets
+                      parent_frame: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,  # cached (mins, ranges)
+                     ) -> Dict[str, torch.Tensor]:
+        """
+        Training path: raw outputs only, no post-processing, no clones and no
+        data-dependent branches, so it captures as one graph. Returns
+          coords_normalized (B, T, 6), coords (B, T, 6) in the parent frame,
+          type_logits (B, T, 3), stop_scores (B, T), parent_mins / parent_ranges (B, 1, 2).
+        """
         device = parent_bezier.device # A tensor that will surely be present
         child_embs = child_embs.to(device)
         parent_embs = parent_embs.to(device)
+        if child_mask is not None: child_mask = child_mask.to(device)
+        if parent_mask is not None: parent_mask = parent_mask.to(device)
 
         # 1. Encode Inputs
-        c_feat = self.encode_text_embeddings(child_embs)
-        p_feat = self.encode_text_embeddings(parent_embs)
-        s_feat = self.encode_parent_shape(parent_bezier)
+        c_feat = self.encode_text_embeddings(child_embs, child_mask)
+        p_feat = self.encode_text_embeddings(parent_embs, parent_mask)
+        s_feat = self.encode_parent_shape(parent_bezier, parent_offsets)
 
         # 2. Fuse Modalities (b_feat is excluded as child is relative to parent)
         mem = self.fuse_modalities(c_feat, p_feat, s_feat)
 
         # 3. Decode child shape attributes
-        decoder_outputs = self.decode_outputs_from_memory(mem)
-        pred_coords_normalized = decoder_outputs["coords_normalized"] # (B, cfg.max_segments, 6)
+        decoder_outputs = self.decode_outputs_from_memory(mem, num_queries)
+        pred_coords_normalized = decoder_outputs["coords_normalized"] # (B, T, 6)
 
         # 4. Scale normalized coordinates relative to the PARENT shape's bounding box
-        # Derive parent_bbox from parent_bezier (assuming parent_bezier coords are absolute)
-        # parent_bezier is (B, max_segments, 6). Reshape to access points.
-        parent_pts_reshaped = parent_bezier.reshape(parent_bezier.size(0), -1, 2) # (B, max_p_seg * 3, 2)
-        
-        mask = parent_pts_reshaped[..., 0] != -1  # Assumes both x and y are -1 together
-
-        # For X coordinates
-        x_vals = parent_pts_reshaped[..., 0]
-        x_masked_min = x_vals.masked_fill(~mask, float('inf'))
-        x_masked_max = x_vals.masked_fill(~mask, float('-inf'))
-        parent_xmin, _ = x_masked_min.min(dim=1, keepdim=True)
-        parent_xmax, _ = x_masked_max.max(dim=1, keepdim=True)
-
-        # For Y coordinates
-        y_vals = parent_pts_reshaped[..., 1]
-        y_masked_min = y_vals.masked_fill(~mask, float('inf'))
-        y_masked_max = y_vals.masked_fill(~mask, float('-inf'))
-        parent_ymin, _ = y_masked_min.min(dim=1, keepdim=True)
-        parent_ymax, _ = y_masked_max.max(dim=1, keepdim=True)
+        if parent_frame is None:
+            parent_frame = self.parent_frame(parent_bezier, parent_offsets)
+        parent_mins, parent_ranges = parent_frame
+        child_pts_reshaped = pred_coords_normalized.reshape(pred_coords_normalized.size(0), -1, 2)
+        scaled_coords = (child_pts_reshaped * parent_ranges + parent_mins).reshape(pred_coords_normalized.shape)
 
-        parent_mins = torch.cat([parent_xmin, parent_ymin], dim=1).unsqueeze(1) # (B, 1, 2)
-        parent_ranges = torch.cat([parent_xmax - parent_xmin, parent_ymax - parent_ymin], dim=1).unsqueeze(1).clamp(min=1e-6) # (B, 1, 2)
+        return {
+            "coords_normalized": pred_coords_normalized,
+            "coords": scaled_coords,
+            "type_logits": decoder_outputs["types_logits"],
+            "stop_scores": decoder_outputs["stop_scores"],
+            "parent_mins": parent_mins,
+            "parent_ranges": parent_ranges,
+        }
 
-        # Scale pred_coords_normalized (0-1) using parent's bounding box
-        child_pts_reshaped = pred_coords_normalized.reshape(pred_coords_normalized.size(0), -1, 2)
-        scaled_child_pts = child_pts_reshaped * parent_ranges + parent_mins
-        scaled_coords = scaled_child_pts.reshape(pred_coords_normalized.shape)
-
-        # 5. Apply post-processing
-        final_pred_coords = scaled_coords.clone()
-        B, T_seq, C_coord = final_pred_coords.shape
-
-        pred_types = torch.argmax(decoder_outputs["types_logits"], dim=-1)
-        col_indices_coord = torch.arange(C_coord, device=final_pred_coords.device)
-
-        mask_type0 = (pred_types == 0)
-        if mask_type0.any():
-            col_mask_4 = (col_indices_coord < 4)
-            effective_mask_type0 = mask_type0.unsqueeze(-1) & col_mask_4.view(1, 1, -1)
-            final_pred_coords.masked_fill_(effective_mask_type0, -1.0)
-
-        mask_type1 = (pred_types == 1)
-        if mask_type1.any():
-            col_mask_2 = (col_indices_coord < 2)
-            effective_mask_type1 = mask_type1.unsqueeze(-1) & col_mask_2.view(1, 1, -1)
-            final_pred_coords.masked_fill_(effective_mask_type1, -1.0)
-
-        stop_indices = decoder_outputs["stop_index"]
-        indices_seq_2D = torch.arange(T_seq, device=final_pred_coords.device).unsqueeze(0)
-        mask_after_stop_2D = indices_seq_2D > stop_indices.unsqueeze(1)
-
-        if mask_after_stop_2D.any():
-            final_pred_coords[mask_after_stop_2D] = -1.0
-        # print(f"Final pred coords shape: {final_pred_coords}, ")
+    def predict(self, *args, **kwargs) -> Dict[str, torch.Tensor]:
+        """
+        Inference path: forward_train plus post-processing. Control points absent
+        for the predicted type and every segment after the predicted stop are set
+        to -1. Same arguments as forward_train.
+        """
+        out = self.forward_train(*args, **kwargs)
+        coords, type_logits = out["coords"], out["type_logits"]
+        B, T_seq, C_coord = coords.shape
+
+        pred_types = torch.argmax(type_logits, dim=-1)                       # (B, T)
+        stop_indices = out["stop_scores"].argmax(dim=1)                      # (B,)
+        col_indices_coord = torch.arange(C_coord, device=coords.device).view(1, 1, -1)
+        indices_seq_2D = torch.arange(T_seq, device=coords.device).unsqueeze(0)
+
+        absent = (
+            ((pred_types == 0).unsqueeze(-1) & (col_indices_coord < 4))     # line: no control points
+            | ((pred_types == 1).unsqueeze(-1) & (col_indices_coord < 2))   # quadratic: no first control point
+            | (indices_seq_2D > stop_indices.unsqueeze(1)).unsqueeze(-1)    # after the stop
+        )
+        final_pred_coords = coords.masked_fill(absent, -1.0)
         return {
             "segments": final_pred_coords,
-            "type_logits": decoder_outputs["types_logits"],
+            "type_logits": type_logits,
             "stops": stop_indices,
-            "stop_scores": decoder_outputs["stop_scores"],
+            "stop_scores": out["stop_scores"],
         }
 
+    # model(...) is the inference path
+    forward = predict
 
 import torch
 import torch.nn.functional as F
@@ -1004,6 +2570,106 @@ import torch.nn.functional as F
 
 #     return loss_shape.item()
 
+class TrainingMetricsLogger:
+    """
+    Per-step training metrics with deferred reduction.
+
+    Loss components stay on the device and are summed there. Every `log_every`
+    steps (and at epoch end) the window is read back with one copy and written
+    as a row to `path`: CSV if it ends in .csv, JSONL otherwise. Each row holds
+    mean losses, samples/sec, data-wait time and step time. Step time is host
+    wall time, so on CUDA it only covers kernel launch unless the step synced.
+    """
+    def __init__(self, path: str, log_every: int = 50):
+        self.path = path
+        self.log_every = max(int(log_every), 1)
+        self.use_csv = path.endswith(".csv")
+        self._csv_fields = None
+        self._jsonl = None if self.use_csv else JsonlSink(path)
+        self.global_step = 0
+        self._epoch = None
+        self._epoch_sums: Dict[str, torch.Tensor] = {}
+        self._epoch_steps = 0
+        self._reset_window()
+
+    def _reset_window(self):
+        self._sums: Dict[str, torch.Tensor] = {}
+        self._steps = 0
+        self._samples = 0
+        self._data_wait = 0.0
+        self._step_time = 0.0
+        self._window_start = time.perf_counter()
+
+    def log_step(self, losses: Dict[str, torch.Tensor], batch_size: int,
+                 data_wait: float, step_time: float, epoch: int) -> None:
+        if epoch != self._epoch:
+            self._epoch, self._epoch_sums, self._epoch_steps = epoch, {}, 0
+        for k, v in losses.items():
+            v = v.detach()
+            self._sums[k] = v if k not in self._sums else self._sums[k] + v
+        self._steps += 1
+        self._samples += int(batch_size)
+        self._data_wait += data_wait
+        self._step_time += step_time
+        self.global_step += 1
+        if self._steps >= self.log_every:
+            self.flush()
+
+    def flush(self) -> Optional[Dict[str, float]]:
+        """Reduces and writes the current window; returns the row (None if empty)."""
+        if self._steps == 0:
+            return None
+        names = list(self._sums)
+        values = torch.stack([self._sums[n].float() for n in names]).cpu().tolist()  # the only sync
+        for n in names:
+            self._epoch_sums[n] = self._epoch_sums.get(n, 0.0) + self._sums[n].float()
+        self._epoch_steps += self._steps
+        elapsed = max(time.perf_counter() - self._window_start, 1e-9)
+        row = {
+            "epoch": self._epoch,
+            "step": self.global_step,
+            "steps": self._steps,
+            "samples_per_sec": self._samples / elapsed,
+            "data_wait_s": self._data_wait / self._steps,
+            "step_time_s": self._step_time / self._steps,
+        }
+        for n, v in zip(names, values):
+            row[f"loss_{n}"] = v / self._steps
+        self._write(row)
+        self._reset_window()
+        return row
+
+    def end_epoch(self) -> Dict[str, float]:
+        """Flushes the partial window and returns this epoch's mean loss per component."""
+        self.flush()
+        if self._epoch_steps == 0:
+            return {}
+        names = list(self._epoch_sums)
+        values = torch.stack([self._epoch_sums[n] for n in names]).cpu().tolist()
+        return {n: v / self._epoch_steps for n, v in zip(names, values)}
+
+    def _write(self, row: Dict) -> None:
+        if not self.use_csv:
+            self._jsonl(row)
+            return
+        import csv
+        # Always append (like JSONL), so a resumed run keeps earlier rows; the header
+        # is written only for a new file, an existing one keeps its own columns
+        write_header = False
+        if self._csv_fields is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+                with open(self.path, newline="") as f:
+                    self._csv_fields = next(csv.reader(f))
+            else:
+                self._csv_fields, write_header = list(row), True
+        with open(self.path, "a", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=self._csv_fields, extrasaction="ignore")
+            if write_header:
+                writer.writeheader()
+            writer.writerow(row)
+
+
 def train_batch(
     model,
     batch,
@@ -1014,67 +2680,105 @@ def train_batch(
     lambda_stop:  float = 10.0,
     lambda_len:   float = 20.0, # Weight for the expected length loss
     lambda_type:  float = 100.0,
-    debug_mode:   bool  = True,
+    debug_mode:   bool  = False, # prints (and syncs on) every 10th batch
+    variable_queries: bool = False, # decode only batch['num_queries'] steps (length-bucketed batches)
+    autocast_dtype: Optional[torch.dtype] = None, # bf16/fp16 autocast for the forward pass (see resolve_precision)
+    scaler=None,                  # GradScaler for fp16; None = plain backward
+    forward_fn=None,              # training forward, e.g. torch.compile(model.forward_train); None = model.forward_train
     # cfg: PolygonConfig = None, # If you need cfg.max_output_segments explicitly
 ):
+    """
+    One optimization step. Returns the detached loss components
+    {"total", "curve", "stop", "count", "type"} as device tensors, so the
+    caller decides when to pay for a device->host sync.
+    """
     # Move batch to device and ensure lengths is float for calculations
     child_embs  = batch['child_embs'].to(device)
     parent_embs = batch['parent_embs'].to(device)
     parent_bbox = batch['parent_bbox'].to(device)
-    parent_segs = batch['parent_bezier_segs'].to(device)
+    if 'parent_bezier_offsets' in batch:
+        # packed parents: only real segments, no 30-row ceiling in the shape encoder
+        parent_segs    = batch['parent_bezier_values'].to(device)
+        parent_offsets = batch['parent_bezier_offsets'].to(device)
+    else:
+        parent_segs    = batch['parent_bezier_segs'].to(device)
+        parent_offsets = None
     gt_curves   = batch['gt_curves'].to(device)         # Shape: [B, T_gt, 6]
     lengths     = batch['lengths'].to(device).float()   # Shape: [B], ground truth number of segments
+    child_mask  = batch['child_mask'].to(device) if 'child_mask' in batch else None   # sequence storage only
+    parent_mask = batch['parent_mask'].to(device) if 'parent_mask' in batch else None
+    # Loss targets come precomputed from the data pipeline ([B, T_gt], see loss_targets)
+    if 'valid_mask' in batch:
+        targets = {k: batch[k].to(device) for k in _TARGET_KEYS}
+    else:
+        targets = loss_targets(gt_curves, lengths)
+    # Parent frame (mins, ranges) from the data pipeline too, so the model does not recompute it
+    parent_frame = (
+        (batch['parent_mins'].to(device), batch['parent_ranges'].to(device))
+        if 'parent_mins' in batch else None
+    )
 
     B = gt_curves.size(0)
     if B == 0: # Handle empty batch if it can occur
-        return 0.0
+        zero = torch.zeros((), device=device)
+        return {"total": zero, "curve": zero, "stop": zero, "count": zero, "type": zero}
         
     teacher_forcing = False # Standard for training autoregressive models
     geom_scale = 50.0 if teacher_forcing else 10.0 # Scale for geometry loss
-    print(1111, child_embs.shape, parent_embs.shape, parent_bbox.shape, parent_segs.shape, gt_curves.shape, lengths.shape)
-    # 1) Forward pass
-    outputs = model(
-        child_embs,
-        parent_embs,
-        parent_segs,
-        # padding_mask=batch.get('parent_padding_mask', None), # Pass if your model uses it
-    )
-    pred_segments = outputs['segments']     # Shape: [B, S, 6] (S = max_output_segments)
-    pred_stops    = outputs['stop_scores']        # Shape: [B, S] (sigmoid probabilities)
-    type_logits   = outputs['type_logits']  # Shape: [B, S, 3]
+    # Host int from the loader (longest child in the batch), so slicing the queries never syncs.
+    # Children longer than the decoder (see the warning in train_model_batched) are cut to it.
+    num_queries = min(batch['num_queries'], model.cfg.max_segments) if variable_queries else None
+    # 1) Forward pass (training path: raw coordinates, no inference post-processing),
+    # under autocast when a reduced precision is requested
+    with torch.autocast(device_type=device.type, dtype=autocast_dtype or torch.float32,
+                        enabled=autocast_dtype is not None):
+        outputs = (forward_fn or model.forward_train)(
+            child_embs,
+            parent_embs,
+            parent_segs,
+            child_mask=child_mask,
+            parent_mask=parent_mask,
+            num_queries=num_queries,
+            parent_offsets=parent_offsets,
+            parent_frame=parent_frame,
+            # padding_mask=batch.get('parent_padding_mask', None), # Pass if your model uses it
+        )
+    # The losses below run in fp32 outside autocast (BCE on fp16 probabilities is unsafe)
+    pred_segments = outputs['coords'].float()       # Shape: [B, S, 6] (S = num_queries or max_output_segments)
+    pred_stops    = outputs['stop_scores'].float()  # Shape: [B, S] (sigmoid probabilities)
+    type_logits   = outputs['type_logits'].float()  # Shape: [B, S, 3]
 
     S = pred_segments.size(1) # Maximum predicted sequence length (max_output_segments)
     T_gt_dim = gt_curves.size(1)  # Padded length of ground truth curves in the batch
 
-    # 2) Create valid_mask based on true lengths for segments that are actually present
-    # valid_mask[b, s] = 1 if segment s of sample b is a real segment (0-indexed), 0 otherwise.
-    # Max index for a real segment is lengths[b]-1.
-    valid_mask = (torch.arange(S, device=device)[None, :] < lengths[:, None]).float()  # Shape: [B, S]
-
-    # 3) Curve L1 loss
-    # Compare up to the minimum of predicted length (S) and ground truth padded length (T_gt_dim),
-    # then use valid_mask for actual elements.
+    # 2) Bring the [B, T_gt] targets to the S predicted steps. Shapes are static, so this
+    # is plain slicing/padding: steps past the GT are invalid, type 0 and "stopped".
+    def fit_steps(t, pad_value):
+        if t.size(1) >= S:
+            return t[:, :S]
+        pad = [0, 0] * (t.dim() - 2) + [0, S - t.size(1)]
+        return F.pad(t, pad, value=pad_value)
+    valid_mask  = fit_steps(targets['valid_mask'], False).float()   # [B, S]
+    target_stop = fit_steps(targets['target_stop'], True).float()   # [B, S]
+    stop_weight = fit_steps(targets['stop_weight'], 5.0)            # [B, S]
+    gt_types    = fit_steps(targets['gt_types'], 0).long()          # [B, S]
+
+    # 3) Curve L1 loss: mean error over the coordinates the real GT segments have.
+    # Control points the GT segment type does not have (-1 in the GT) carry no loss;
+    # predict() sets them to -1 from the predicted type instead. Every real segment is
+    # supervised, whatever the predicted stop.
     compare_len_curve = min(S, T_gt_dim)
-    
     pred_for_curve = pred_segments[:, :compare_len_curve, :]    # [B, compare_len_curve, 6]
     gt_for_curve   = gt_curves[:, :compare_len_curve, :]        # [B, compare_len_curve, 6]
-    mask_for_curve = valid_mask[:, :compare_len_curve]          # [B, compare_len_curve]
-
-    err = (pred_for_curve - gt_for_curve).abs() * mask_for_curve.unsqueeze(-1)
-    num_valid_coords = (mask_for_curve.sum() * 6).clamp(min=1e-9) # Avoid division by zero
+    coord_mask     = targets['coord_mask'][:, :compare_len_curve].to(pred_for_curve.dtype)
+    err = (pred_for_curve - gt_for_curve).abs() * coord_mask
+    num_valid_coords = coord_mask.sum().clamp(min=1e-9) # Avoid division by zero
     loss_curve = lambda_curve * (err.sum() / num_valid_coords) * geom_scale
 
     # 4) Stop-token loss (Binary Cross-Entropy)
-    # target_stop[b,s] = 1 if s >= (lengths[b]-1) (actual stop index), else 0.
-    # Meaning, stop signal should be 0 for segments before the last true segment,
-    # and 1 at the last true segment and for all subsequent potential segments.
-    idxs_S = torch.arange(S, device=device)[None, :].expand(B, -1) # [B,S] tensor of [0,1,...,S-1]
-    stop_idx_gt = (lengths - 1).clamp(min=0)[:, None] # [B,1], index of the last true segment.
-    target_stop = (idxs_S >= stop_idx_gt).float()     # [B,S]
-
-    weight_for_stop_loss = torch.where(target_stop > 0, 5.0, 1.0) # As in original
+    # Stop signal is 0 before the last true segment, 1 at it and for all later steps.
     loss_stop = lambda_stop * F.binary_cross_entropy(
-        pred_stops, target_stop, weight=weight_for_stop_loss, reduction='mean'
+        pred_stops, target_stop, weight=stop_weight, reduction='mean'
     ) * geom_scale
 
     # 5) Expected Length Loss (New count loss)
@@ -1098,63 +2802,27 @@ def train_batch(
     
     loss_count = lambda_len * (expected_length - lengths).abs().mean() * geom_scale
 
-    # 6) Type classification loss
-    # Uses valid_mask (Shape: [B,S]) to select only relevant logits and labels.
-    # type_logits is [B, S, 3].
-    print(f"Type logits shape: {type_logits.shape}, valid_mask shape: {valid_mask.shape}")
-    type_logits_for_loss = type_logits[valid_mask.bool()] # Shape: [N_valid_total_segments, 3]
-
-    # Derive gt_types from gt_curves. gt_curves is [B, T_gt_dim, 6].
-    # We need ground truth types for all positions indicated by valid_mask.
-    # Max index in valid_mask is S-1. gt_curves might be shorter than S.
-    
-    # Determine the source length for gt_types based on T_gt_dim and S
-    gt_types_source_len = min(T_gt_dim, S)
-    
-    gt_c1 = gt_curves[:, :gt_types_source_len, :2]
-    gt_c2 = gt_curves[:, :gt_types_source_len, 2:4]
-
-    gt_line_mask_full  = (gt_c1 < 0).all(dim=-1) & (gt_c2 < 0).all(dim=-1)
-    gt_quad_mask_full  = (gt_c1 < 0).all(dim=-1) & ~(gt_c2 < 0).all(dim=-1)
-    # Original cubic definition: gt_cubic = ~(gt_line | gt_quad)
-    gt_cubic_mask_full = ~(gt_line_mask_full | gt_quad_mask_full) 
-    
-    gt_types_potential = torch.zeros((B, gt_types_source_len), dtype=torch.long, device=device)
-    gt_types_potential[gt_quad_mask_full] = 1
-    gt_types_potential[gt_cubic_mask_full] = 2
-    
-    # Ensure gt_types_for_masking has dimension S to match valid_mask
-    if gt_types_source_len < S:
-        padding_shape = (B, S - gt_types_source_len)
-        # Pad with type 0 (line/default). These will be ignored if not in valid_mask.
-        padding_types = torch.zeros(padding_shape, dtype=torch.long, device=device) 
-        gt_types_for_masking = torch.cat([gt_types_potential, padding_types], dim=1)
-    else:
-        gt_types_for_masking = gt_types_potential[:, :S] # Ensure it's not longer than S
-
-    gt_types_for_loss = gt_types_for_masking[valid_mask.bool()] # Shape: [N_valid_total_segments]
-
-    if type_logits_for_loss.numel() > 0:
-        if type_logits_for_loss.size(0) == gt_types_for_loss.size(0):
-            loss_type = lambda_type * F.cross_entropy(type_logits_for_loss, gt_types_for_loss) * geom_scale
-        else:
-            print(f"Warning: Mismatch in elements for type loss. Logits: {type_logits_for_loss.size(0)}, Labels: {gt_types_for_loss.size(0)}. Setting type loss to 0.")
-            loss_type = torch.tensor(0.0, device=device, dtype=total_loss.dtype if 'total_loss' in locals() else torch.float32)
-    else: # No valid segments to compute type loss (e.g., all lengths are 0)
-        loss_type = torch.tensor(0.0, device=device, dtype=total_loss.dtype if 'total_loss' in locals() else torch.float32)
+    # 6) Type classification loss: masked mean of the per-step cross-entropy over real
+    # segments (no boolean indexing, so the shapes stay static); 0 with no real segments.
+    type_ce = F.cross_entropy(
+        type_logits.reshape(-1, type_logits.size(-1)), gt_types.reshape(-1), reduction='none'
+    ).view(B, S)
+    loss_type = lambda_type * (type_ce * valid_mask).sum() / valid_mask.sum().clamp(min=1.0) * geom_scale
 
     # 7) Total loss & backward
     total_loss = loss_curve + loss_stop + loss_count + loss_type
     
     optimizer.zero_grad()
-    # If using mixed precision (torch.cuda.amp.autocast), scaler is needed:
-    # scaler.scale(total_loss).backward()
-    # scaler.step(optimizer)
-    # scaler.update()
-    total_loss.backward()
-    # Optional: Gradient clipping
-    # torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
-    optimizer.step()
+    if scaler is not None:
+        # fp16: scale the loss so small gradients do not underflow
+        scaler.scale(total_loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+    else:
+        total_loss.backward()
+        # Optional: Gradient clipping
+        # torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
+        optimizer.step()
 
     if debug_mode and (batch_idx % 10 == 0 or batch_idx < 5): # Print more often initially or for specific intervals
         print(
@@ -1166,7 +2834,78 @@ def train_batch(
             f"TrueLen={lengths.mean().item():.2f}"
         )
 
-    return total_loss.item()
+    return {
+        "total": total_loss.detach(),
+        "curve": loss_curve.detach(),
+        "stop":  loss_stop.detach(),
+        "count": loss_count.detach(),
+        "type":  loss_type.detach(),
+    }
+
+
+PRECISIONS = ("fp32", "bf16-cpu", "fp16-cuda")
+
+
+def resolve_precision(precision: str, device: torch.device):
+    """
+    Maps a precision name to (device, autocast_dtype, scaler) for train_batch:
+      fp32       no autocast, on `device`
+      bf16-cpu   bfloat16 CPU autocast (forces the CPU); no scaler, bf16 keeps fp32's range
+      fp16-cuda  float16 CUDA autocast with a GradScaler; requires CUDA
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"precision must be one of {PRECISIONS}, got {precision!r}")
+    if precision == "fp32":
+        return device, None, None
+    if precision == "bf16-cpu":
+        if device.type != "cpu":
+            print(f"Warning: precision='bf16-cpu' overrides device {device} -> cpu; training runs on the CPU.")
+        return torch.device("cpu"), torch.bfloat16, None
+    if not torch.cuda.is_available():
+        raise ValueError("precision='fp16-cuda' needs a CUDA device")
+    scaler = torch.amp.GradScaler("cuda") if hasattr(torch.amp, "GradScaler") else torch.cuda.amp.GradScaler()
+    return torch.device("cuda"), torch.float16, scaler
+
+
+def benchmark_precisions(ds, precisions=("fp32", "bf16-cpu"), batch_size: int = 32,
+                         steps: int = 20, warmup: int = 3, seed: int = 0) -> Dict[str, float]:
+    """
+    Training throughput (samples/sec) of train_batch for each precision on `ds`,
+    with a fresh headless model per precision (same seed, same batches).
+    Prints each result and its speedup over fp32 when fp32 is included.
+    """
+    if len(ds) == 0:
+        raise ValueError("benchmark_precisions needs a non-empty dataset")
+    default_device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    loader = DataLoader(ds, batch_size=batch_size, shuffle=False, collate_fn=collate_fn)
+    batches = []
+    while len(batches) < warmup + steps:
+        batches.extend(loader)
+    batches = batches[:warmup + steps]
+    hidden_size = ds.dataset.hidden_size if isinstance(ds, Subset) else ds.hidden_size
+
+    results = {}
+    for precision in precisions:
+        device, autocast_dtype, scaler = resolve_precision(precision, default_device)
+        torch.manual_seed(seed)
+        model = PolygonPredictor(PolygonConfig(load_text_encoder=False, text_hidden_size=hidden_size)).to(device)
+        model.train()
+        optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+        samples, elapsed = 0, 0.0
+        for i, batch in enumerate(batches):
+            t0 = time.perf_counter()
+            losses = train_batch(model, batch, optimizer, device, i,
+                                 autocast_dtype=autocast_dtype, scaler=scaler)
+            losses["total"].item()  # wait for the step to finish
+            if i >= warmup:
+                elapsed += time.perf_counter() - t0
+                samples += batch['lengths'].size(0)
+        results[precision] = samples / max(elapsed, 1e-9)
+        line = f"{precision:>10}: {results[precision]:.1f} samples/sec"
+        if precision != "fp32" and "fp32" in results:
+            line += f" ({results[precision] / results['fp32']:.2f}x fp32)"
+        print(line)
+    return results
 
 
 def save_checkpoint(model, optimizer, epoch, current_best_loss, checkpoint_path):
@@ -1197,6 +2936,7 @@ def save_checkpoint(model, optimizer, epoch, current_best_loss, checkpoint_path)
     
     checkpoint = {
         "epoch": epoch,
+        "model_config": asdict(unwrapped_model.cfg),
         "model_state_dict": filtered_state_dict,
         'optimizer_state_dict': optimizer.state_dict(),
         'best_loss': current_best_loss,
@@ -1212,6 +2952,37 @@ def save_checkpoint(model, optimizer, epoch, current_best_loss, checkpoint_path)
     return checkpoint
 
 
+def _checkpoint_causal_decoder(ckpt) -> bool:
+    """
+    causal_decoder setting of a checkpoint. Checkpoints from before the field
+    existed are treated as the bidirectional decoder, with a warning.
+    """
+    model_config = ckpt.get("model_config", {})
+    if "causal_decoder" not in model_config:
+        print("Warning: checkpoint model_config has no 'causal_decoder'; assuming the "
+              "bidirectional decoder (causal_decoder=False).")
+        return False
+    return bool(model_config["causal_decoder"])
+
+
+def load_polygon_predictor(checkpoint_path, device, cfg: Optional[PolygonConfig] = None):
+    """
+    Rebuilds a headless PolygonPredictor from a checkpoint written by save_checkpoint.
+    Uses the stored model_config (falls back to `cfg`), so no T5 weights are loaded.
+    Returns (model, checkpoint).
+    """
+    ckpt = torch.load(checkpoint_path, map_location=device)
+    if "model_config" in ckpt:
+        cfg = PolygonConfig(**ckpt["model_config"])
+    elif cfg is None:
+        cfg = PolygonConfig()
+    # a copy: the caller's config is never modified
+    cfg = dataclasses.replace(cfg, load_text_encoder=False, causal_decoder=_checkpoint_causal_decoder(ckpt))
+    model = PolygonPredictor(cfg=cfg).to(device)
+    model.load_state_dict(ckpt["model_state_dict"], strict=False)
+    return model, ckpt
+
+
 def train_model_batched(
     dataset_path,
     model_name=None,# Checkpoint path to resume from
@@ -1221,35 +2992,88 @@ def train_model_batched(
     batch_size=None,
     max_samples=None,
     run_visualization=False,
+    embedding_cache_dir=None,
+    geometry_cache_dir=None,
+    text_storage="sequence",
+    activation_stats_every=0, # >0: log decoder activation mean/std every N steps
+    metrics_every=50,         # steps between rows in output_dir/train_metrics.jsonl
+    preprocess_workers=0,     # processes for per-scene mask geometry (0 = in-process)
+    roi_geometry=False,       # fit masks on their tight ROI (see check_roi_geometry); default full frame
+    shard_dir=None,           # preprocessed store (see preprocess_to_shards); used instead of dataset_path if set
+    device_resident=False,    # upload the whole dataset to the device once and batch there (DeviceResidentLoader)
+    bucket_by_length=False,   # LengthBucketBatchSampler + decoder queries trimmed to each batch's longest shape
+    precision="fp32",         # "fp32", "bf16-cpu" or "fp16-cuda" (see resolve_precision)
 ):
     import traceback # For detailed error in visualization
 
     os.makedirs(output_dir, exist_ok=True)
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    print(f"[Training run] Device: {device}")
-
-    ds = AugmentedDataset(root_dir=dataset_path, max_samples=max_samples)
+    device, autocast_dtype, scaler = resolve_precision(precision, device)
+    print(f"[Training run] Device: {device}, precision: {precision}")
+
+    if shard_dir:
+        ds = ShardedSampleDataset(shard_dir)
+        if max_samples:
+            ds = Subset(ds, range(min(max_samples, len(ds))))
+        hidden_size = ds.dataset.hidden_size if isinstance(ds, Subset) else ds.hidden_size
+        print(f"Loaded {len(ds)} preprocessed samples from {shard_dir}")
+    else:
+        ds = AugmentedDataset(
+            root_dir=dataset_path, max_samples=max_samples,
+            embedding_cache_dir=embedding_cache_dir, text_storage=text_storage,
+            num_workers=preprocess_workers, geometry_cache_dir=geometry_cache_dir,
+            roi_geometry=roi_geometry,
+        )
+        hidden_size = ds.hidden_size
     if len(ds) == 0: raise RuntimeError("Empty dataset!")
+    unload_t5_encoder()  # embeddings are precomputed; the headless model below never needs T5
     N = len(ds)
     actual_batch_size = N if batch_size is None else batch_size
-    loader = DataLoader(
-        ds,
-        batch_size=actual_batch_size,
-        shuffle=True,
-        num_workers=0,      # <–– no subprocesses
-        pin_memory=False,   # if your CPU→GPU transfer is a bottleneck, try toggling
-        collate_fn=collate_fn
+    bucket_sampler = (
+        LengthBucketBatchSampler(_dataset_lengths(ds), actual_batch_size, shuffle=True)
+        if bucket_by_length else None
     )
+    if device_resident:
+        loader = DeviceResidentLoader(ds, actual_batch_size, device, shuffle=True, batch_sampler=bucket_sampler)
+        print(f"Dataset resident on {device}: {N} samples")
+    elif bucket_sampler is not None:
+        loader = DataLoader(
+            ds,
+            batch_sampler=bucket_sampler,
+            num_workers=0,
+            pin_memory=False,
+            collate_fn=collate_fn
+        )
+    else:
+        loader = DataLoader(
+            ds,
+            batch_size=actual_batch_size,
+            shuffle=True,
+            num_workers=0,      # <–– no subprocesses
+            pin_memory=False,   # if your CPU→GPU transfer is a bottleneck, try toggling
+            collate_fn=collate_fn
+        )
 
-    # It's good practice to have model configuration in one place
-    # For now, using the hardcoded values as per your PolygonPredictor snippet
-    cfg=PolygonConfig()
-    
+    # The dataset already holds the text embeddings, so the model never needs T5 itself
+    # Length-bucketed batches decode only their longest child, which needs the causal decoder
+    cfg=PolygonConfig(load_text_encoder=False, text_hidden_size=hidden_size, causal_decoder=bucket_by_length)
+    num_too_long = int((_dataset_lengths(ds) > cfg.max_segments).sum())
+    if num_too_long:
+        print(f"Warning: {num_too_long} of {N} children have more than {cfg.max_segments} segments; "
+              f"the decoder predicts at most {cfg.max_segments}, so their later segments get no loss.")
 
     model = PolygonPredictor(
         cfg=cfg
     ).to(device)
 
+    activation_stats = None
+    if activation_stats_every > 0:
+        activation_stats = ActivationStats(
+            flush_every=activation_stats_every,
+            sink=JsonlSink(os.path.join(output_dir, "activation_stats.jsonl"))
+        )
+        model.coord_decoder.activation_stats = activation_stats
+
     optimizer = torch.optim.Adam(
         filter(lambda p: p.requires_grad, model.parameters()), lr=learning_rate,betas=(0.9, 0.95),weight_decay=0.0
     )
@@ -1261,7 +3085,12 @@ def train_model_batched(
     if model_name and os.path.exists(model_name):
         print(f"Resuming training from checkpoint: {model_name}")
         ckpt = torch.load(model_name, map_location=device)
-        
+        if _checkpoint_causal_decoder(ckpt) != cfg.causal_decoder:
+            raise ValueError(
+                f"Checkpoint {model_name} was trained with causal_decoder={not cfg.causal_decoder}, "
+                f"but bucket_by_length={bucket_by_length} needs causal_decoder={cfg.causal_decoder}."
+            )
+
         # Determine if the model to load into was compiled
         model_to_load = model
         if hasattr(model, "_orig_mod"): # If 'model' is already compiled
@@ -1313,45 +3142,47 @@ def train_model_batched(
     best_model_path = os.path.join(output_dir, "best_model.pth") # Unified best model name
 
     torch.backends.cudnn.benchmark = True
+    # Only the training path is compiled, as a separate callable handed to train_batch:
+    # the model itself stays eager (predict(), checkpoints, subclasses unaffected)
+    train_forward = model.forward_train
     if torch.__version__ >= "2.0.0": # torch.compile is stable in 2.0+
         print("Attempting to compile model with torch.compile()...")
         try:
-            # Important: If you compile, ensure saving/loading handles the _orig_mod attribute
-            # or load state_dict into the uncompiled model before compiling.
-            # The current loading logic tries to load into model_to_load (which would be uncompiled if 'model' isn't compiled yet).
-            # If 'model' is already compiled when loading, model_to_load = model._orig_mod is correct.
-            model = torch.compile(model)
+            train_forward = torch.compile(model.forward_train)
             print("Model compiled successfully.")
         except Exception as e: # Catch broader exceptions as compile can fail for various reasons
             print(f"Model compilation failed: {e}. Proceeding without compilation.")
     
-    # scaler = GradScaler() # Initialize if using mixed precision
+    metrics = TrainingMetricsLogger(os.path.join(output_dir, "train_metrics.jsonl"), log_every=metrics_every)
 
     print(f"Starting training from epoch {start_epoch} up to {num_epochs}.")
     print(f"Batch size: {actual_batch_size}. Overfitting {N} samples if batch_size == N.")
 
     for epoch in range(start_epoch, num_epochs + 1):
-        with torch.cuda.amp.autocast():
-            model.train()
-        epoch_total_loss = 0.0
-        # Store individual losses for epoch average
-        epoch_losses_components = {"stop": 0.0, "se": 0.0, "curve": 0.0, "len": 0.0, "start": 0.0}
-        
+        model.train()
 
+        t_prev = time.perf_counter()
         for batch_idx, batch_data in enumerate(loader):
-            # Assuming train_batch now returns a tuple of all loss components
-            # total_loss_item, stop_item, se_item, curve_item, len_item, start_item
-            loss_value = train_batch(
-                model, batch_data, optimizer, device, batch_idx, # Pass current best_loss
+            t_data = time.perf_counter()
+            losses = train_batch(
+                model, batch_data, optimizer, device, batch_idx,
+                variable_queries=bucket_by_length,
+                autocast_dtype=autocast_dtype, scaler=scaler, forward_fn=train_forward,
             )
-            
-            epoch_total_loss += loss_value
-            
+            t_step = time.perf_counter()
+            if activation_stats is not None:
+                activation_stats.step()
+            metrics.log_step(
+                losses, batch_size=batch_data['lengths'].size(0),
+                data_wait=t_data - t_prev, step_time=t_step - t_data, epoch=epoch,
+            )
+            t_prev = time.perf_counter()  # after logging, so its cost is not counted as data wait
 
-        avg_epoch_loss = epoch_total_loss / len(loader) if len(loader) > 0 else float('nan')
+        # Loss components were kept on the device; reduce them once per epoch
+        epoch_losses_components = metrics.end_epoch()
+        avg_epoch_loss = epoch_losses_components.pop("total", float('nan'))
         log_msg = f"Epoch {epoch:3d}/{num_epochs} — Total Loss: {avg_epoch_loss:.6f}"
-        for name, total_val in epoch_losses_components.items():
-            avg_comp_loss = total_val / len(loader) if len(loader) > 0 else float('nan')
+        for name, avg_comp_loss in epoch_losses_components.items():
             log_msg += f" — {name}L: {avg_comp_loss:.4f}"
         print(log_msg)
 
@@ -1372,6 +3203,9 @@ def train_model_batched(
             gc.collect()
             torch.cuda.empty_cache()
 
+    if activation_stats is not None:
+        activation_stats.flush()
+
     final_path = os.path.join(output_dir, "final_model.pth")
     # Save final model using the epoch number of the last completed epoch and the overall best_loss found
     save_checkpoint(model, optimizer, num_epochs, best_loss, final_path) 
@@ -1380,20 +3214,10 @@ def train_model_batched(
     # Load the best model for visualization
     if os.path.exists(best_model_path):
         print(f"Loading best model from {best_model_path} for visualization.")
-        best_ckpt = torch.load(best_model_path, map_location=device)
-        vis_epoch_num = best_ckpt.get('epoch', 'unknown') # Get epoch from best checkpoint
-
         # Re-initialize model for visualization to avoid issues with compiled model state for visualization
         # Use the same configuration used for training
-        vis_model = PolygonPredictor(
-            cfg=cfg
-        ).to(device)
-        
-        model_to_load_vis = vis_model
-        if hasattr(vis_model, "_orig_mod"): # Should not be compiled yet as it's fresh
-             model_to_load_vis = vis_model._orig_mod
-
-        model_to_load_vis.load_state_dict(best_ckpt["model_state_dict"], strict=False)
+        vis_model, best_ckpt = load_polygon_predictor(best_model_path, device, cfg=cfg)
+        vis_epoch_num = best_ckpt.get('epoch', 'unknown') # Get epoch from best checkpoint
         print(f"Best model (epoch {vis_epoch_num}) loaded for visualization.")
 
         if run_visualization:
@@ -1493,6 +3317,8 @@ def visualize_predictions(model, dataset, device, output_dir, epoch, max_vis=20)
             pe = sample['parent_embs'].unsqueeze(0).to(device)          # [1, seq_len, d]
             bb = sample['parent_bbox'].unsqueeze(0).to(device)          # [1,4,2]
             pseg = sample['parent_bezier_segs'].unsqueeze(0).to(device)# [1,T,6]
+            cm   = sample['child_mask'].unsqueeze(0).to(device) if 'child_mask' in sample else None
+            pm   = sample['parent_mask'].unsqueeze(0).to(device) if 'parent_mask' in sample else None
             gt   = sample['gt_curves']                                  # [T_gt,6]
 
             # draw bbox rectangle in normalized coords
@@ -1509,7 +3335,7 @@ def visualize_predictions(model, dataset, device, output_dir, epoch, max_vis=20)
             # model forward
             with torch.no_grad():
                 out = model(
-                    ce, pe, pseg
+                    ce, pe, pseg, child_mask=cm, parent_mask=pm
                 )
 
             pred_segs  = out['segments'][0].cpu().numpy()    # [T,6]
@@ -1554,6 +3380,60 @@ def visualize_predictions(model, dataset, device, output_dir, epoch, max_vis=20)
 # Main Entry Point
 # =============================================================================
 if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == "preprocess":
+        # python boundedShapePredSOTA.py preprocess <dataset_root> <shard_dir> [options]
+        import argparse
+        parser = argparse.ArgumentParser(prog=f"{sys.argv[0]} preprocess")
+        parser.add_argument("dataset_path")
+        parser.add_argument("shard_dir")
+        parser.add_argument("--shard-size", type=int, default=4096)
+        parser.add_argument("--max-samples", type=int, default=None)
+        parser.add_argument("--text-storage", choices=("sequence", "pooled"), default="sequence")
+        parser.add_argument("--embedding-cache-dir", default=None)
+        parser.add_argument("--geometry-cache-dir", default=None)
+        parser.add_argument("--workers", type=int, default=0)
+        parser.add_argument("--roi-geometry", action="store_true",
+                            help="fit masks on their tight ROI (check with check-roi first)")
+        args = parser.parse_args(sys.argv[2:])
+        preprocess_to_shards(
+            args.dataset_path, args.shard_dir, shard_size=args.shard_size,
+            max_samples=args.max_samples, text_storage=args.text_storage,
+            embedding_cache_dir=args.embedding_cache_dir,
+            geometry_cache_dir=args.geometry_cache_dir, num_workers=args.workers,
+            roi_geometry=args.roi_geometry,
+        )
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "check-roi":
+        # python boundedShapePredSOTA.py check-roi <dataset_root> [--epsilon 0.01]
+        import argparse
+        parser = argparse.ArgumentParser(prog=f"{sys.argv[0]} check-roi")
+        parser.add_argument("dataset_path")
+        parser.add_argument("--epsilon", type=float, default=0.01)
+        args = parser.parse_args(sys.argv[2:])
+        sys.exit(1 if check_roi_geometry(args.dataset_path, epsilon=args.epsilon) else 0)
+    if len(sys.argv) > 1 and sys.argv[1] == "self-check":
+        # python boundedShapePredSOTA.py self-check   (vectorized rewrites vs their reference implementations)
+        failed = check_split_and_fit() + check_context_points() + check_context_points_gpu()
+        sys.exit(1 if failed else 0)
+    if len(sys.argv) > 1 and sys.argv[1] == "benchmark":
+        # python boundedShapePredSOTA.py benchmark <dataset_root | shard_dir> [options]
+        import argparse
+        parser = argparse.ArgumentParser(prog=f"{sys.argv[0]} benchmark")
+        parser.add_argument("data", help="dataset root, or a preprocessed shard dir (has index.json)")
+        parser.add_argument("--precisions", nargs="+", default=["fp32", "bf16-cpu"], choices=PRECISIONS)
+        parser.add_argument("--batch-size", type=int, default=32)
+        parser.add_argument("--steps", type=int, default=20)
+        parser.add_argument("--max-samples", type=int, default=None)
+        args = parser.parse_args(sys.argv[2:])
+        if os.path.exists(os.path.join(args.data, "index.json")):
+            bench_ds = ShardedSampleDataset(args.data)
+        else:
+            bench_ds = AugmentedDataset(root_dir=args.data, max_samples=args.max_samples)
+            unload_t5_encoder()
+        benchmark_precisions(bench_ds, precisions=args.precisions, batch_size=args.batch_size, steps=args.steps)
+        sys.exit(0)
+
     # --- Create Dummy Data (if needed for testing) ---
     # (Consider adding a small dummy dataset creation here if running standalone)
     create_dummy = False